@@ -3,10 +3,17 @@
 
 import network
 import os
+import binascii
 import socket
+import struct
+from array import array
 import time
 import ntptime
 import dht
+import gc
+import json
+from collections import deque
+import machine
 import uasyncio as asyncio
 from machine import Pin
 
@@ -17,359 +24,1763 @@ Soil_Pin = 27
 Light_Pin = 28
 Relay1 = Pin(0, Pin.OUT)
 Relay2 = Pin(1, Pin.OUT)
+## Relay for grow lights, None when no lights are attached (e.g., 2 for a third relay on GPIO 2)
+Lights_Pin = None
+Relay3 = Pin(Lights_Pin, Pin.OUT) if Lights_Pin is not None else None
 
 ## Turn relays and on-board LED OFF (if rebooting RPP)
 led.value(0)
 Relay1.value(1)
 Relay2.value(1)
+if Relay3 is not None:
+    Relay3.value(1)
 
 # User configuration
 ## low, medium, high = 5, 1, 0.5 minutes
 LoggingRate = "high"
-## Soil Aridity Limit (%)
+## Soil Aridity Limit (%), watering is needed again once soil has been this much wetter
 WaterSoilAt = 40
+SoilHysteresis = 5
 ## Engage Water Pump
 WaterForSeconds = 1
+## Shortest time between waterings (seconds), letting water soak in before the next reading counts
+WaterCooldown = 900
+## Fan on above this humidity (%) or temperature (C), off again below them minus 5% or 2C
+FanHumidityAt = 75
+FanTemperatureAt = 30
 ## Engage Fan
 SpinForSeconds = 120
+## Shortest time the fan stays off between runs (seconds)
+FanCooldown = 300
+## Actuators pause below this light level (%)
+DarkAt = 5
 ## LED light duration
 LightOnSeconds = 3600
 ## Notify when greenhouse temperatures reach:
 TemperatureHigh = 37
 TemperatureLow = 5
-## Time between checking for problems (bad conditions)
+## Time between repeated notifications of the same problem (bad conditions)
 PollingRate = 1800
+## Times are shown as UTC plus this many minutes (e.g., 60 for British Summer Time), logs always keep UTC
+UTCOffset = 0
+## Most data lost on a power cut: log writes are held in memory for up to this many records or seconds
+BufferRecords = 20
+BufferSeconds = 600
+## "normal" keeps Wi-Fi and the web server up all the time, "low" is for running on batteries: the Pico sleeps
+## between samples and only turns Wi-Fi on for ServeWindow seconds every ServeEvery seconds (set at start-up)
+PowerMode = "normal"
+ServeEvery = 3600
+ServeWindow = 300
+## Battery capacity (mAh), for the runtime estimate in "/metrics"
+BatteryCapacity = 10000
 
 ## Network credentials
 ssid = 'SSID'
 password = 'SomePassword'
 
-# Connect to WiFi using credentials
-def connect():
-    wifi = network.WLAN(network.STA_IF)
-    wifi.active(True)
-    # Power saving mode off
-    wifi.config(pm = 0xa11140)
-    wifi.connect(ssid, password)
-    while wifi.isconnected() == False:
-        print("Connecting...")
-        time.sleep(1)
-    print(wifi.ifconfig())
-
-try:
-    connect()
-except KeyboardInterrupt:
-    machine.reset()
-# on-board RPP LED ON after network is connected
-led.value(1)
+# Wi-Fi is connected in the background by "WiFiManager()", nothing else waits for it
+## States: "idle" (not started), "connecting", "connected", "backoff" (waiting to try again after a failure)
+## and "off" (radio powered down between serve windows in low-power mode)
+## An attempt is given ConnectTimeout seconds, failures are retried after ConnectRetry seconds doubling up to
+## ConnectRetryMax, and a connected link is checked every LinkCheck seconds
+ConnectTimeout = 20
+ConnectRetry = 5
+ConnectRetryMax = 600
+LinkCheck = 10
+WiFi = {"state": "idle", "connects": 0, "drops": 0, "failures": 0}
+# Connect and disconnect events: "NetworkUp" is set while connected, "NetworkDown" while not
+NetworkUp = asyncio.Event()
+NetworkDown = asyncio.Event()
+NetworkDown.set()
 
 # Set network time protocol host URL (external)
 ntptime.host = "uk.pool.ntp.org"
 
-# Network connection retrieves time from NTP host
-# Must have network to configure
-def SetTime():
-    try:
-        ntptime.settime()
-        print("Time synced")
-    except:
-        print("Connecting to NTP...")
-        time.sleep(1)
-        SetTime()
-
-SetTime()
-
-# Extract data from Tuple and return String
-## Output is always in UTC (add +1 for British Summer Time clock change)
+# Network connection retrieves time from NTP host, in the background by "TimeService()"
+## Timestamps come from the ticks_ms() counter anchored to the last sync, corrected for the drift measured between syncs
+## Synced every SyncEvery seconds, a failed sync is retried after SyncRetry seconds, doubling up to SyncRetryMax
+SyncEvery = 6 * 3600
+SyncRetry = 10
+SyncRetryMax = 1800
+## Anchor: epoch seconds plus "ms" milliseconds at ticks_ms() "ticks" (no epoch until the first sync)
+## "drift_ppm" corrects the ticks counter (positive when it runs slow), "since_ms" is ticks time since the last sync
+## "step" is how far the first sync moved the clock
+TimeSync = {"epoch": None, "ms": 0, "ticks": 0, "since_ms": 0, "drift_ppm": 0, "step": 0, "syncs": 0, "failures": 0}
+# Set once the clock has been synced
+TimeSynced = asyncio.Event()
+
+# Current epoch seconds: from the anchored ticks counter once synced, the RTC until then
+def Now():
+    if TimeSync["epoch"] is None:
+        return time.time()
+    Elapsed = time.ticks_diff(time.ticks_ms(), TimeSync["ticks"])
+    return TimeSync["epoch"] + (TimeSync["ms"] + Elapsed + Elapsed * TimeSync["drift_ppm"] // 1000000) // 1000
+
+# Move the anchor up to now, so the ticks counter never runs long enough to wrap around
+def Reanchor():
+    Ticks = time.ticks_ms()
+    Elapsed = time.ticks_diff(Ticks, TimeSync["ticks"])
+    Total = TimeSync["ms"] + Elapsed + Elapsed * TimeSync["drift_ppm"] // 1000000
+    TimeSync["epoch"] += Total // 1000
+    TimeSync["ms"] = Total % 1000
+    TimeSync["ticks"] = Ticks
+    TimeSync["since_ms"] += Elapsed
+
+# Set the RTC from NTP and re-anchor the clock to it
+## NTP gives whole seconds, so the sync is taken as half way through the second,
+## and drift is only measured over an hour or more
+def SyncTime():
+    Before = Now()
+    ntptime.settime()
+    Actual = time.time()
+    Ticks = time.ticks_ms()
+    if TimeSync["epoch"] is None:
+        TimeSync["step"] = Actual - Before
+    else:
+        Reanchor()
+        if TimeSync["since_ms"] >= 3600000:
+            Error = Actual * 1000 + 500 - (TimeSync["epoch"] * 1000 + TimeSync["ms"])
+            Drift = TimeSync["drift_ppm"] + Error * 1000000 // TimeSync["since_ms"] // 2
+            TimeSync["drift_ppm"] = max(-1000, min(1000, Drift))
+    TimeSync["epoch"], TimeSync["ms"], TimeSync["ticks"], TimeSync["since_ms"] = Actual, 500, Ticks, 0
+    TimeSync["syncs"] += 1
+
+async def TimeService():
+    Retry = SyncRetry
+    Wait = 0
+    while True:
+        # Wake at least hourly to move the anchor on, and only sync once there is a network
+        while Wait > 0 or not NetworkUp.is_set():
+            if Wait > 0:
+                await asyncio.sleep(min(Wait, 3600))
+                Wait -= 3600
+            else:
+                try:
+                    await asyncio.wait_for(NetworkUp.wait(), 3600)
+                except asyncio.TimeoutError:
+                    pass
+            if TimeSynced.is_set():
+                Reanchor()
+        Start = time.ticks_us()
+        try:
+            SyncTime()
+            Observe("time_sync", Start)
+            print("Time synced")
+            Wait = SyncEvery
+            Retry = SyncRetry
+            if not TimeSynced.is_set():
+                TimeSynced.set()
+                FixUnsynced(TimeSync["step"])
+                await Notification("Clock set by NTP, moved by " + str(TimeSync["step"]) + " seconds", LevelInfo, "time")
+        except Exception as e:
+            TimeSync["failures"] += 1
+            Count("time_sync_error")
+            print("NTP sync failed, " + str(e))
+            Wait = Retry
+            Retry = min(Retry * 2, SyncRetryMax)
+
+# Lightweight timing and counters for the hot paths, exported at "/metrics"
+## Timings: (name, label): [calls, total microseconds, longest microseconds]
+Timings = {}
+## Counters: (name, label): count
+Counters = {}
+## Memory high-water marks and event loop lag (late wake-ups of a task sleeping for one second)
+Memory = {"free_min": None, "alloc_max": 0}
+LoopLag = {"count": 0, "sum_ms": 0, "max_ms": 0}
+BootTicks = time.ticks_ms()
+
+# Record the time since "Start" (from time.ticks_us()) against a name
+def Observe(Name, Start, Label=""):
+    Elapsed = time.ticks_diff(time.ticks_us(), Start)
+    T = Timings.get((Name, Label))
+    if T is None:
+        T = Timings[(Name, Label)] = [0, 0, 0]
+    T[0] += 1
+    T[1] += Elapsed
+    if Elapsed > T[2]:
+        T[2] = Elapsed
+
+def Count(Name, Label=""):
+    Counters[(Name, Label)] = Counters.get((Name, Label), 0) + 1
+
+def WatchMemory():
+    Free = gc.mem_free()
+    Allocated = gc.mem_alloc()
+    if Memory["free_min"] is None or Free < Memory["free_min"]:
+        Memory["free_min"] = Free
+    if Allocated > Memory["alloc_max"]:
+        Memory["alloc_max"] = Allocated
+
+# Measure how late the event loop wakes a sleeping task, a sign of something blocking it
+async def WatchLoop():
+    while True:
+        Scheduled = time.ticks_add(time.ticks_ms(), 1000)
+        await asyncio.sleep(1)
+        Lag = max(0, time.ticks_diff(time.ticks_ms(), Scheduled))
+        LoopLag["count"] += 1
+        LoopLag["sum_ms"] += Lag
+        if Lag > LoopLag["max_ms"]:
+            LoopLag["max_ms"] = Lag
+        WatchMemory()
+
+# Energy use, estimated from the time spent in each power state and a rough current draw for each
+## "awake" and "sleep" (machine.lightsleep) add up to the uptime, "radio" is time with Wi-Fi powered, on top of awake
+## Draws (mA) are typical of a Pico W, replace them with your own measurements for a better estimate
+PowerDraw = {"awake": 25, "radio": 55, "sleep": 2}
+## Milliseconds in each state, added up from "ticks" (ticks_ms()) whenever the state changes or the estimate is read
+Energy = {"awake": 0, "radio": 0, "sleep": 0}
+EnergyState = {"ticks": BootTicks, "radio": False}
+
+def Account(Slept=False):
+    Ticks = time.ticks_ms()
+    Elapsed = time.ticks_diff(Ticks, EnergyState["ticks"])
+    EnergyState["ticks"] = Ticks
+    Energy["sleep" if Slept else "awake"] += Elapsed
+    if EnergyState["radio"]:
+        Energy["radio"] += Elapsed
+
+# Charge used so far (mAh), average current (mA) and hours a full battery would last at that average
+def EnergyBudget():
+    Account()
+    Hours = (Energy["awake"] + Energy["sleep"]) / 3600000
+    Used = sum(Energy[State] * PowerDraw[State] for State in Energy) / 3600000
+    Average = Used / Hours if Hours else 0
+    return Used, Average, (BatteryCapacity / Average if Average else 0)
+
+# Low-power mode ("PowerMode"): between samples the Pico is stopped in machine.lightsleep(), with Wi-Fi powered down
+## Every ServeEvery seconds a serve window opens for ServeWindow seconds: "RadioWanted" is set, "WiFiManager()"
+## connects and the web server runs, and the Pico stays awake until the window closes and the radio is off again
+RadioWanted = asyncio.Event()
+## ticks_ms() the last serve window opened at
+ServeWindowTicks = None
+## Tasks that need the Pico awake until they finish (e.g., a relay timing how long it is on)
+KeepAwake = 0
+## Milliseconds given to tasks woken by a sample (rules, relays, page updates) before sleeping
+SettleMs = 200
+
+def LowPower():
+    return BootPowerMode == "low"
+
+# Wait for the next sample, asleep when nothing needs the Pico awake (only in low-power mode)
+async def Rest(Seconds):
+    global ServeWindowTicks
+    Account()
+    if not LowPower():
+        await asyncio.sleep(Seconds)
+        return
+    Until = time.ticks_add(time.ticks_ms(), Seconds * 1000)
+    await asyncio.sleep_ms(SettleMs)
+    while True:
+        Ticks = time.ticks_ms()
+        Left = time.ticks_diff(Until, Ticks)
+        if Left <= 0:
+            return
+        if ServeWindowTicks is None or time.ticks_diff(Ticks, ServeWindowTicks) >= ServeEvery * 1000:
+            ServeWindowTicks = Ticks
+            RadioWanted.set()
+        elif RadioWanted.is_set() and time.ticks_diff(Ticks, ServeWindowTicks) >= ServeWindow * 1000:
+            RadioWanted.clear()
+        if RadioWanted.is_set() or EnergyState["radio"] or KeepAwake:
+            await asyncio.sleep_ms(min(Left, 1000))
+            continue
+        # Held log records go to flash in one batch per wake, before sleeping
+        FlushDue()
+        Account()
+        machine.lightsleep(Left)
+        Account(True)
+
+# Timestamps are kept as epoch seconds (UTC) everywhere and only formatted when shown or exported
+
+# Time and date columns of the CSV download, in the format it has always had
+## Output is always in UTC
 ## Expected format of outputs: 13/12/2023, 13:59:59
-def GetDate():
-    LocalDate = time.localtime()
+def GetDate(Epoch):
+    LocalDate = time.localtime(Epoch)
     DateFormatted = ('{day}/{month}/{year}' .format(day=LocalDate[2], month=LocalDate[1], year=LocalDate[0]))
     return DateFormatted
 
-def GetTime():
-    LocalTime = time.localtime()
+def GetTime(Epoch):
+    LocalTime = time.localtime(Epoch)
     TimeFormatted = ('{hour}:{minute}:{second}' .format(hour=LocalTime[3], minute=LocalTime[4], second=LocalTime[5]))
     return TimeFormatted
 
+# ISO-8601 time for pages and notifications, shifted by "UTCOffset" (e.g., 2023-12-13T13:59:59+01:00)
+def FormatTime(Epoch):
+    T = time.gmtime(Epoch + UTCOffset * 60)
+    if UTCOffset:
+        Zone = "{}{:02d}:{:02d}".format("+" if UTCOffset > 0 else "-", abs(UTCOffset) // 60, abs(UTCOffset) % 60)
+    else:
+        Zone = "Z"
+    return "{:04d}-{:02d}-{:02d}T{:02d}:{:02d}:{:02d}{}".format(T[0], T[1], T[2], T[3], T[4], T[5], Zone)
+
+# Analogue sensors are read in bursts, the ADC objects are made once and kept
+## Each reading is the mean of a burst of conversions with the highest and lowest "BurstTrim" dropped as outliers
+BurstSize = 32
+BurstTrim = 8
+ADCs = {}
+# One preallocated buffer for every burst
+Burst = array('H', [0] * BurstSize)
+# Pin number: (latest filtered reading %, variance of the kept conversions in %^2)
+SensorStats = {}
+
+# Take a burst of raw conversions and return (trimmed mean, variance) in raw units (0-65535)
+def ReadBurst(PinNumber):
+    adc = ADCs.get(PinNumber)
+    if adc is None:
+        adc = ADCs[PinNumber] = machine.ADC(PinNumber)
+    for n in range(BurstSize):
+        Burst[n] = adc.read_u16()
+    # Insertion sort in place (small burst, no allocation)
+    for i in range(1, BurstSize):
+        value = Burst[i]
+        j = i - 1
+        while j >= 0 and Burst[j] > value:
+            Burst[j + 1] = Burst[j]
+            j -= 1
+        Burst[j + 1] = value
+    Kept = BurstSize - 2 * BurstTrim
+    Total = 0
+    for n in range(BurstTrim, BurstSize - BurstTrim):
+        Total += Burst[n]
+    Mean = Total // Kept
+    Squares = 0
+    for n in range(BurstTrim, BurstSize - BurstTrim):
+        Squares += (Burst[n] - Mean) * (Burst[n] - Mean)
+    return Total / Kept, Squares / Kept
+
 # Take constants configured by user and return analogue reading
 ## Range: (0-65535 or 2^16 bits)
 def GetSensorData(PinNumber):
     try:
-        aSensor = machine.ADC(PinNumber).read_u16()
+        aSensor, Variance = ReadBurst(PinNumber)
         ## Make percentage of sensor range and round
         aSensor = round((aSensor/(2 ** 16 - 1)) * 100, 2)
-        return str(aSensor)
+        SensorStats[PinNumber] = (aSensor, Variance * (100 / (2 ** 16 - 1)) ** 2)
+        return aSensor
     except Exception as e:
-        print ("No reading from pin: " + PinNumber + (str(e)))
+        print ("No reading from pin: " + str(PinNumber) + (str(e)))
 
 # Digital sensor reader "DHT11"
-## Temperature and Humidity range and format: 0% to 100% (as String)
-async def GetDHT():
-    d = dht.DHT11(machine.Pin(DHT11_Pin))
+## Temperature and Humidity range: 0% to 100%
+async def GetDHT(d):
+    Start = time.ticks_us()
     try:
         d.measure()
-        temp = str(d.temperature())
-        hum = str(d.humidity())
+        temp = d.temperature()
+        hum = d.humidity()
         x = hum, temp
+        Observe("dht", Start)
         return x
     ## Specific DHT11 software crashes if read too frequently (e.g., <1s intervals)
     ## Will take error to console if debugging
     except Exception as e:
-        await Notification(str(e))
-        print ("No reading from DHT module")
-
-# Assemble the sensor readings in a comma-separated string
+        Count("dht_error")
+        print ("No reading from DHT module: " + str(e))
+
+# The DHT11 is only read by one background task owning the sensor (or with each sample in low-power mode),
+## everything else takes its last good reading
+## Reads are "DHTReadEvery" seconds apart, failures are retried after DHTInterval seconds, doubling up to DHTBackoffMax
+## Readings older than DHTStaleSeconds are marked as stale
+DHTReadEvery = 10
+DHTInterval = 2
+DHTBackoffMax = 60
+DHTStaleSeconds = 120
+# Last good reading with the Now() and ticks_ms() it was taken at, and failures since
+DHTReading = {"humidity": None, "temperature": None, "time": None, "ticks": None, "failures": 0}
+# Set once the first good reading is in
+DHTReady = asyncio.Event()
+
+DHTSensor = dht.DHT11(machine.Pin(DHT11_Pin))
+
+# Read the DHT11 once, keeping a good reading, and notify once per run of failures
+async def ReadDHT():
+    x = await GetDHT(DHTSensor)
+    if x:
+        if DHTReading["failures"]:
+            await Notification("DHT readings resumed after " + str(DHTReading["failures"]) + " failures", LevelInfo, "dht")
+        DHTReading["humidity"], DHTReading["temperature"] = x
+        DHTReading["time"] = Now()
+        DHTReading["ticks"] = time.ticks_ms()
+        DHTReading["failures"] = 0
+        DHTReady.set()
+        return True
+    DHTReading["failures"] += 1
+    if DHTReading["failures"] == 1:
+        await Notification("No reading from DHT module", LevelWarning, "dht")
+    return False
+
+async def DHTReader():
+    Delay = DHTInterval
+    while True:
+        if await ReadDHT():
+            Delay = DHTInterval
+            await asyncio.sleep(DHTReadEvery)
+        else:
+            # Back off after a failure
+            await asyncio.sleep(Delay)
+            Delay = min(Delay * 2, DHTBackoffMax)
+
+# Last good DHT reading without waiting: (humidity, temperature, stale)
+## Before the first good reading the values are 0 and stale
+def LatestDHT():
+    if DHTReading["ticks"] is None:
+        return 0, 0, True
+    Stale = time.ticks_diff(time.ticks_ms(), DHTReading["ticks"]) > DHTStaleSeconds * 1000
+    return DHTReading["humidity"], DHTReading["temperature"], Stale
+
+# Assemble the sensor readings in a sample tuple: (epoch, soil, light, temperature, humidity)
 async def Juncture():
-    aDHT = await GetDHT()
-    atime = GetTime()
-    adate = GetDate()
+    Start = time.ticks_us()
+    aDHT = LatestDHT()
+    aepoch = Now()
     light = GetSensorData(Light_Pin)
     soil = GetSensorData(Soil_Pin)
     temperature = aDHT[1]
     humidity = aDHT[0]
-    CombinedReadings = [atime,adate,soil,light,temperature,humidity]
-    StringData = ','.join(CombinedReadings)
-    return StringData
-
-
-# Take in a data line to store, a max array size, and set pooled data in an existing global variable
-def UpdateList(MyInput, MaxArray, StoreVar):
-    Separate = SplitListByComma(MyInput)
-    StoreVar.append(Separate)
-    while (len(StoreVar) > MaxArray):
-        StoreVar.pop(0)
-    BuildList = []
-    for entry in StoreVar:
-        BuildList.append(entry)
-    return BuildList
+    Observe("juncture", Start)
+    return (aepoch, soil, light, temperature, humidity)
+
+# Packed sample record, 14 bytes instead of ~36 as a CSV line:
+## epoch seconds, then soil, light, temperature, humidity as scaled uint16, then a flags byte and a checksum byte
+## Readings are stored in hundredths, temperature is offset so it stays unsigned
+SampleFormat = "<IHHHHBB"
+SampleSize = struct.calcsize(SampleFormat)
+TemperatureOffset = 40
+## Flags: temperature and humidity are an old (or no) DHT reading
+FlagDHTStale = 1
+## Taken before the clock was first synced, the epoch is from the unset RTC
+FlagUnsynced = 2
+## Last byte is a checksum of the rest (records written before checksums were added don't have this flag)
+FlagChecked = 128
+
+# Low byte of the CRC-32 of a record without its checksum byte, enough to catch a record torn by a power cut
+def Checksum(record):
+    return binascii.crc32(memoryview(record)[:SampleSize - 1]) & 0xff
+
+def RecordValid(record):
+    if record[SampleSize - 2] & FlagChecked:
+        return record[SampleSize - 1] == Checksum(record)
+    # Records from before checksums only had the two lowest flag bits, and a zero last byte
+    return record[SampleSize - 1] == 0 and record[SampleSize - 2] < 4
+
+# Records readers take: undamaged and with a real time
+## Unsynced records only reach flash when more were taken than "HoldUnsynced()" keeps, their epochs are out of order
+def RecordUsable(record):
+    return RecordValid(record) and not record[SampleSize - 2] & FlagUnsynced
+
+def ScaleReading(value, offset=0):
+    return min(max(int(round((value + offset) * 100)), 0), 65535)
+
+def PackSample(sample, Flags=0):
+    Record = bytearray(SampleSize)
+    struct.pack_into(SampleFormat, Record, 0, sample[0], ScaleReading(sample[1]), ScaleReading(sample[2]),
+                     ScaleReading(sample[3], TemperatureOffset), ScaleReading(sample[4]), Flags | FlagChecked, 0)
+    Record[SampleSize - 1] = Checksum(Record)
+    return Record
+
+## With "Blank", temperature and humidity are None when the DHT reading was stale (or there never was one),
+## rather than the old or placeholder values stored
+def UnpackSample(record, Blank=False):
+    R = struct.unpack(SampleFormat, record)
+    if Blank and R[5] & FlagDHTStale:
+        return (R[0], round(R[1]/100, 2), round(R[2]/100, 2), None, None)
+    return (R[0], round(R[1]/100, 2), round(R[2]/100, 2), round(R[3]/100 - TemperatureOffset, 2), round(R[4]/100, 2))
+
+# DHT11 readings are whole numbers, keep them formatted as integers like the sensor reports them
+## A missing reading (None) is left blank
+def FormatWhole(value):
+    if value is None:
+        return ""
+    if value == int(value):
+        return str(int(value))
+    return str(value)
+
+# Readings of a sample as strings: soil, light, temperature, humidity
+def ReadingFields(sample):
+    return [str(float(sample[1])), str(float(sample[2])), FormatWhole(sample[3]), FormatWhole(sample[4])]
+
+# Columns of a sample as strings, in the order of the CSV export: time, date, soil, light, temperature, humidity
+def SampleFields(sample):
+    return [GetTime(sample[0]), GetDate(sample[0])] + ReadingFields(sample)
+
+# One line of the CSV export (e.g., 13:5:9,13/12/2023,41.23,77.1,21,55)
+def SampleToCSV(sample):
+    return ','.join(SampleFields(sample))
+
+# Read every stored sample back from a log store, oldest first, skipping damaged records
+## Samples still held in a write-behind buffer (see "WriteBehind") follow those on file
+def ReadSamples(store, buffer=None):
+    for record in store.Records(SampleSize):
+        if RecordUsable(record):
+            yield UnpackSample(record, True)
+    if buffer:
+        for record in buffer.Records(SampleSize):
+            if RecordUsable(record):
+                yield UnpackSample(record, True)
+
+# Recent samples held in memory as one preallocated array per column, overwritten in a ring
+## Appending is O(1) and never allocates, columns are read in place without copying
+class SampleRing:
+    def __init__(self, Capacity):
+        self.Capacity = Capacity
+        # Next position to be written, and number of samples held
+        self.Head = 0
+        self.Count = 0
+        # Samples appended since boot, changes with every sample (used to tell when cached pages are out of date)
+        self.Appended = 0
+        # Columns: epoch, soil, light, temperature, humidity
+        self.Columns = (array('I', [0] * Capacity), array('f', [0] * Capacity), array('f', [0] * Capacity),
+                        array('f', [0] * Capacity), array('f', [0] * Capacity))
+        # Whether each sample's DHT reading was stale (or missing)
+        self.Stale = bytearray(Capacity)
+
+    def __len__(self):
+        return self.Count
+
+    def Append(self, sample, Stale=False):
+        for n in range(5):
+            self.Columns[n][self.Head] = sample[n]
+        self.Stale[self.Head] = Stale
+        self.Head = (self.Head + 1) % self.Capacity
+        self.Appended += 1
+        if self.Count < self.Capacity:
+            self.Count += 1
+
+    # Position in the arrays of the n-th held sample (0 is the oldest)
+    def Index(self, n):
+        return (self.Head - self.Count + n) % self.Capacity
+
+    # Zero-copy views of one column, oldest part first (the second view is empty until the ring wraps)
+    def Views(self, Column):
+        View = memoryview(self.Columns[Column])
+        Start = self.Index(0)
+        if self.Count < self.Capacity:
+            return View[Start:Start + self.Count], View[0:0]
+        return View[Start:], View[:Start]
+
+    # Iterate one column, oldest first
+    def Values(self, Column):
+        for View in self.Views(Column):
+            for value in View:
+                yield value
+
+    # Stale flags, oldest first
+    def StaleFlags(self):
+        for n in range(self.Count):
+            yield self.Stale[self.Index(n)]
+
+    # Sample tuple, temperature and humidity are None when the DHT reading was stale
+    def Row(self, n):
+        i = self.Index(n)
+        C = self.Columns
+        if self.Stale[i]:
+            return (C[0][i], round(C[1][i], 2), round(C[2][i], 2), None, None)
+        return (C[0][i], round(C[1][i], 2), round(C[2][i], 2), round(C[3][i], 2), round(C[4][i], 2))
+
+    # Iterate sample tuples oldest first, optionally only the most recent number of them
+    def Rows(self, Last=None):
+        First = 0
+        if Last is not None and Last < self.Count:
+            First = self.Count - Last
+        for n in range(First, self.Count):
+            yield self.Row(n)
+
+    def Latest(self):
+        if self.Count:
+            return self.Row(self.Count - 1)
+
+# Samples kept in memory for the graph (240 = 2 hours on "high" logging rate)
+SampleWindow = 240
+StoredInstances = SampleRing(SampleWindow)
+# Most recent rows shown in the logs table
+TableRows = 200
+
+# The logs table as a ring of rows already rendered as HTML bytes
+## Each sample renders one row and replaces the oldest, so a page only copies the held rows out
+class RowRing:
+    def __init__(self, Capacity):
+        self.Capacity = Capacity
+        self.Slots = [b""] * Capacity
+        self.Head = 0
+        self.Count = 0
+    
+    def __len__(self):
+        return self.Count
+    
+    # Replace a held row, counted back from the newest (0)
+    def Set(self, Back, row):
+        self.Slots[(self.Head - 1 - Back) % self.Capacity] = row
+    
+    def Clear(self):
+        self.Slots = [b""] * self.Capacity
+        self.Head = 0
+        self.Count = 0
+    
+    def Append(self, row):
+        self.Slots[self.Head] = row
+        self.Head = (self.Head + 1) % self.Capacity
+        if self.Count < self.Capacity:
+            self.Count += 1
+    
+    # Rows oldest first, joined into batches of "Batch" rows to be sent together
+    ## Taken as they were when called, rows appended while the caller awaits are left for the next time
+    def Batches(self, Batch=16):
+        Slots, Count = self.Slots[:], self.Count
+        First = self.Head - Count
+        for n in range(0, Count, Batch):
+            yield b"".join(Slots[(First + i) % self.Capacity] for i in range(n, min(n + Batch, Count)))
+
+LogTable = RowRing(TableRows)
+
+# Min/max/mean of each reading over fixed time buckets, kept in a ring of "Slots" buckets
+## Each sample updates only the newest bucket (O(1)), so long spans never need the log re-read
+class Rollup:
+    def __init__(self, Width, Slots):
+        self.Width = Width
+        self.Slots = Slots
+        self.Head = 0
+        self.Count = 0
+        self.Starts = array('I', [0] * Slots)
+        self.Counts = array('H', [0] * Slots)
+        # Samples with a fresh DHT reading, the only ones taken for temperature and humidity
+        self.DHTCounts = array('H', [0] * Slots)
+        # Per reading (soil, light, temperature, humidity)
+        self.Minimums = [array('f', [0] * Slots) for n in range(4)]
+        self.Maximums = [array('f', [0] * Slots) for n in range(4)]
+        self.Sums = [array('f', [0] * Slots) for n in range(4)]
+
+    # Start of the newest bucket, None when there are none
+    def Newest(self):
+        if self.Count:
+            return self.Starts[(self.Head - 1) % self.Slots]
+
+    # Samples in a bucket that reading "n" (0 to 3) was taken from
+    def Samples(self, n, Slot):
+        return self.DHTCounts[Slot] if n >= 2 else self.Counts[Slot]
+
+    ## With "Stale" only soil and light are taken, temperature and humidity are an old (or no) DHT reading
+    def Update(self, sample, Stale=False):
+        Start = sample[0] - sample[0] % self.Width
+        Slot = (self.Head - 1) % self.Slots
+        if not self.Count or self.Starts[Slot] != Start:
+            # Start a new bucket, overwriting the oldest when full
+            Slot = self.Head
+            self.Head = (self.Head + 1) % self.Slots
+            if self.Count < self.Slots:
+                self.Count += 1
+            self.Starts[Slot] = Start
+            self.Counts[Slot] = 0
+            self.DHTCounts[Slot] = 0
+            for n in range(4):
+                self.Sums[n][Slot] = 0
+        self.Counts[Slot] += 1
+        if not Stale:
+            self.DHTCounts[Slot] += 1
+        for n in range(2 if Stale else 4):
+            value = sample[n + 1]
+            if self.Samples(n, Slot) == 1:
+                self.Minimums[n][Slot] = self.Maximums[n][Slot] = value
+            elif value < self.Minimums[n][Slot]:
+                self.Minimums[n][Slot] = value
+            if value > self.Maximums[n][Slot]:
+                self.Maximums[n][Slot] = value
+            self.Sums[n][Slot] += value
+
+    # Bucket positions in the arrays, oldest first
+    def Order(self):
+        for n in range(self.Count):
+            yield (self.Head - self.Count + n) % self.Slots
+
+    def Times(self):
+        for Slot in self.Order():
+            yield self.Starts[Slot]
+
+    # Mean of one reading per bucket, None for a bucket without any
+    def Means(self, Reading):
+        for Slot in self.Order():
+            Count = self.Samples(Reading, Slot)
+            yield round(self.Sums[Reading][Slot] / Count, 2) if Count else None
+
+    # One bucket packed for saving, and a saved bucket put back as the newest
+    ## A saved bucket that is not a whole bucket start later than the newest (e.g., damaged) is turned down
+    def PackBucket(self, Slot):
+        return struct.pack(RollupBucket, self.Starts[Slot], self.Counts[Slot], self.DHTCounts[Slot],
+                           *([self.Minimums[n][Slot] for n in range(4)] + [self.Maximums[n][Slot] for n in range(4)] + [self.Sums[n][Slot] for n in range(4)]))
+
+    def LoadBucket(self, data):
+        R = struct.unpack(RollupBucket, data)
+        if R[0] % self.Width or not R[1] or R[2] > R[1] or (self.Count and R[0] <= self.Newest()):
+            return False
+        Slot = self.Head
+        self.Head = (self.Head + 1) % self.Slots
+        if self.Count < self.Slots:
+            self.Count += 1
+        self.Starts[Slot], self.Counts[Slot], self.DHTCounts[Slot] = R[0], R[1], R[2]
+        for n in range(4):
+            self.Minimums[n][Slot], self.Maximums[n][Slot], self.Sums[n][Slot] = R[3 + n], R[7 + n], R[11 + n]
+        return True
+
+# Saved rollup bucket: start, count, count with a fresh DHT reading, then minimums, maximums and sums of the four readings
+RollupBucket = "<IHH12f"
+
+# Per-minute buckets for 6 hours and per-hour buckets for 7 days
+MinuteRollup = Rollup(60, 360)
+HourRollup = Rollup(3600, 168)
+Rollups = {"minute": MinuteRollup, "hour": HourRollup}
 
 # Translate user configuration to useful machine interval
+LoggingIntervals = {"high": 30, "medium": 60, "low": 300}
+
 def LoggingFrequency():
-    if LoggingRate == "high":
-        return 30
-    elif LoggingRate == "medium":
-        return 60
-    else:
-        return 300
-
-# (Test code for calculating memory use, requiring header: "import gc")
-# "memory: " + str(gc.mem_free()) + " / " + str(gc.mem_alloc()
-
-async def GetFileSize(file):
-    FileSize = os.stat(file)
-    # Calculate filesize in Kibibyte
-    return (FileSize[6]/1024)
-
-async def Truncate(file):
-    # Free space in Kibibyte
-    SystemSpace = (2048)
-    # Reserve 10% of system space for system files
-    FreeSpace = (SystemSpace - float(SystemSpace*0.1))
-    if (await GetFileSize(file) > FreeSpace):
+    return LoggingIntervals.get(LoggingRate, 300)
+
+# Settings changed at run time, without reflashing: kept in "config.json" and applied over the defaults above
+## The file is read once at start-up, "Config" holds what it set, and each setting is applied to its global
+## so running tasks pick it up on their next tick ("PowerMode" takes effect on the next start-up,
+## Wi-Fi credentials on the next connection)
+ConfigFile = "config.json"
+## Setting: (int, lowest, highest) or (str, allowed values, None for any)
+ConfigSchema = {
+    "LoggingRate": (str, tuple(LoggingIntervals)),
+    "WaterSoilAt": (int, 0, 100),
+    "SoilHysteresis": (int, 0, 50),
+    "WaterForSeconds": (int, 1, 600),
+    "WaterCooldown": (int, 0, 86400),
+    "FanHumidityAt": (int, 0, 100),
+    "FanTemperatureAt": (int, -10, 60),
+    "SpinForSeconds": (int, 1, 3600),
+    "FanCooldown": (int, 0, 86400),
+    "DarkAt": (int, 0, 100),
+    "LightOnSeconds": (int, 1, 86400),
+    "TemperatureHigh": (int, -10, 60),
+    "TemperatureLow": (int, -10, 60),
+    "PollingRate": (int, 60, 86400),
+    "UTCOffset": (int, -720, 840),
+    "PowerMode": (str, ("normal", "low")),
+    "ServeEvery": (int, 600, 86400),
+    "ServeWindow": (int, 60, 3600),
+    "BatteryCapacity": (int, 100, 100000),
+    "ssid": (str, None),
+    "password": (str, None),
+}
+## Never sent back by "/api/config"
+ConfigSecrets = ("password",)
+Config = {}
+
+# Reason the settings are invalid, or None when they are fine
+def ConfigProblem(Settings):
+    if not isinstance(Settings, dict):
+        return "settings must be a JSON object"
+    for Name in Settings:
+        Rule = ConfigSchema.get(Name)
+        value = Settings[Name]
+        if Rule is None:
+            return "unknown setting " + str(Name)
+        if Rule[0] is str:
+            if not isinstance(value, str) or len(value) > 64 or (Rule[1] and value not in Rule[1]):
+                return Name + " must be " + (" or ".join(Rule[1]) if Rule[1] else "text")
+        elif isinstance(value, bool) or not isinstance(value, int) or not Rule[1] <= value <= Rule[2]:
+            return Name + " must be a whole number from " + str(Rule[1]) + " to " + str(Rule[2])
+    Merged = dict((Name, Settings.get(Name, globals()[Name])) for Name in ConfigSchema)
+    if Merged["TemperatureLow"] >= Merged["TemperatureHigh"]:
+        return "TemperatureLow must be below TemperatureHigh"
+    if Merged["ServeWindow"] > Merged["ServeEvery"]:
+        return "ServeWindow must not be longer than ServeEvery"
+    return None
+
+def ApplyConfig(Settings):
+    globals().update(Settings)
+    # Cached page parts and table rows may show the old time offset
+    Fragments.Clear()
+    if "UTCOffset" in Settings:
+        RenderTable()
+
+# Read the settings file, keeping the defaults if it is missing or invalid
+def LoadConfig():
+    global Config
+    try:
+        with open(ConfigFile) as f:
+            Settings = json.load(f)
+    except OSError:
+        return
+    except ValueError:
+        print("Settings file is not valid JSON, using defaults")
+        return
+    Problem = ConfigProblem(Settings)
+    if Problem:
+        print("Settings file not used, " + Problem)
+        return
+    Config = Settings
+    globals().update(Settings)
+
+# Validate and save changed settings, then apply them
+## Written to a temporary file and renamed over the old one, so a power cut never leaves half a file
+def SaveConfig(Changes):
+    global Config
+    Problem = ConfigProblem(Changes)
+    if Problem:
+        return Problem
+    Settings = dict(Config)
+    Settings.update(Changes)
+    with open(ConfigFile + ".tmp", "w") as f:
+        json.dump(Settings, f)
+    os.rename(ConfigFile + ".tmp", ConfigFile)
+    Config = Settings
+    ApplyConfig(Changes)
+    return None
+
+LoadConfig()
+# Power mode in use, set once at start-up: the tasks started depend on it, so a changed "PowerMode" waits for a restart
+BootPowerMode = PowerMode
+
+# Free space in Kibibyte
+SystemSpace = (2048)
+# Reserve 10% of system space for system files
+FreeSpace = (SystemSpace - float(SystemSpace*0.1))
+
+# Log storage split over a fixed number of segment files ("log.000", "log.001", ...)
+## Only the newest segment is appended to, once full a new one is started and the oldest is deleted
+## Retention is then O(1) and never needs the whole log in memory or a full rewrite of flash
+class SegmentedLog:
+    def __init__(self, Prefix, SegmentCount, SpaceKiB):
+        self.Prefix = Prefix
+        self.SegmentCount = SegmentCount
+        # Bytes allowed in each segment before rolling over
+        self.SegmentSize = int(SpaceKiB * 1024 / SegmentCount)
+        # Sequence numbers of segments on file, oldest first
+        self.Segments = []
+        for name in os.listdir():
+            if name.startswith(Prefix + "."):
+                try:
+                    self.Segments.append(int(name[len(Prefix) + 1:]))
+                except ValueError:
+                    pass
+        self.Segments.sort()
+        if not self.Segments:
+            self.Segments.append(0)
+
+    def Name(self, Sequence):
+        return "{}.{:03d}".format(self.Prefix, Sequence)
+
+    def Active(self):
+        return self.Name(self.Segments[-1])
+
+    def Append(self, data):
+        with open(self.Active(), "ab" if isinstance(data, (bytes, bytearray)) else "a") as f:
+            f.write(data)
+
+    # Start a new segment when the active one is full (or when forced), deleting the oldest beyond the segment count
+    ## A new segment is only a new file name, so a power cut here can't damage what is already stored
+    def Rotate(self, Force=False):
+        try:
+            if os.stat(self.Active())[6] < self.SegmentSize and not Force:
+                return False
+        except OSError:
+            return False
+        self.Segments.append(self.Segments[-1] + 1)
+        while len(self.Segments) > self.SegmentCount:
+            try:
+                os.remove(self.Name(self.Segments.pop(0)))
+            except OSError:
+                pass
+        return True
+
+    # Read back fixed-size binary records, oldest first, re-using one buffer for every record
+    def Records(self, Size):
+        Buffer = bytearray(Size)
+        for Sequence in self.Segments:
+            try:
+                f = open(self.Name(Sequence), "rb")
+            except OSError:
+                continue
+            with f:
+                while f.readinto(Buffer) == Size:
+                    yield Buffer
+
+    # Read back the last "Count" fixed-size records, oldest first, from the newest segments only
+    ## Segments are sized up from the newest back to find where to start, so the read is bounded by "Count"
+    ## however big the log is
+    def Tail(self, Size, Count):
+        Starts = []
+        for Sequence in reversed(self.Segments):
+            if Count <= 0:
+                break
+            try:
+                Records = os.stat(self.Name(Sequence))[6] // Size
+            except OSError:
+                continue
+            Take = min(Records, Count)
+            Starts.append((Sequence, Records - Take))
+            Count -= Take
+        Buffer = bytearray(Size)
+        for Sequence, First in reversed(Starts):
+            with open(self.Name(Sequence), "rb") as f:
+                f.seek(First * Size)
+                while f.readinto(Buffer) == Size:
+                    yield Buffer
+
+    # The last "Count" lines, oldest first, from at most "Bytes" read off the end of the newest segments
+    def TailLines(self, Count, Bytes):
+        Lines = []
+        for Sequence in reversed(self.Segments):
+            if len(Lines) >= Count or Bytes <= 0:
+                break
+            try:
+                Length = os.stat(self.Name(Sequence))[6]
+            except OSError:
+                continue
+            Take = min(Length, Bytes)
+            Bytes -= Take
+            with open(self.Name(Sequence), "rb") as f:
+                f.seek(Length - Take)
+                Parts = f.read(Take).split(b"\n")
+            # The first line is cut short unless the read started at the beginning of the segment
+            if Take < Length:
+                Parts = Parts[1:]
+            Lines = [line for line in Parts if line] + Lines
+        return Lines[-Count:]
+
+    # Check the end of the active segment at start: after a power cut part of the last batch may be missing or damaged
+    ## "Valid" checks the last "Size" bytes, stepping back a record at a time (at most "Depth" records) to the last good one,
+    ## so the check takes the same time however big the log is
+    ## A damaged end is left in place (readers skip bad records) and writing goes on in a new segment,
+    ## so later records can't be misaligned by a partial one; returns the number of damaged bytes
+    def Recover(self, Size, Valid, Depth):
         try:
-            with open(file, "r+") as f:
-                
-                # Find out lines in code
-                TotalLines = (sum(1 for _ in f))
-                f.seek(0)
-                
-                NumberOfKeptLines = 1000
-
-                # Starting line position in file
-                n = (TotalLines - NumberOfKeptLines)
-                line_offset = []
-                offset = 0
-                for line in f:
-                    line_offset.append(offset)
-                    offset += len(line)
-                f.seek(line_offset[n])
-                
-                LinesStored = ""
-                for line in range(NumberOfKeptLines):
-                    LinesStored = LinesStored + (next(f))
-                    
-            print("Truncating file from lines " + str(n) + " to " + str(n+NumberOfKeptLines))
-                    
-            # Open file as "w" automatically wiping file clean, apply new data
-            with open(file, "w") as f:
-                f.write(LinesStored)
+            Length = os.stat(self.Active())[6]
+        except OSError:
+            return 0
+        Good = Length // Size
+        Buffer = bytearray(Size)
+        with open(self.Active(), "rb") as f:
+            while Good > 0 and Length // Size - Good < Depth:
+                f.seek((Good - 1) * Size)
+                f.readinto(Buffer)
+                if Valid(Buffer):
+                    break
+                Good -= 1
+        Damaged = Length - Good * Size
+        if Damaged:
+            self.Rotate(True)
+        return Damaged
+
+# Notification lines kept over 4 segments ("note.000", ...) in NotificationSpace Kibibyte
+NotificationSpace = 32
+NotificationLog = SegmentedLog("note", 4, NotificationSpace)
+# Packed sensor samples kept over 8 segments sharing the rest of the usable file system space
+SampleLog = SegmentedLog("log", 8, FreeSpace - NotificationSpace)
+
+# Batch log writes in memory and write them to flash together, saving an open/write/close per record
+## Flushed once "MaxRecords" are held or the oldest has waited "MaxSeconds",
+## which bounds what a power cut can lose; "Target" is called with the batched bytes
+class WriteBehind:
+    def __init__(self, Name, Target, MaxRecords, MaxSeconds):
+        self.Name = Name
+        self.Target = Target
+        self.MaxRecords = MaxRecords
+        self.MaxSeconds = MaxSeconds
+        self.Data = bytearray()
+        self.Held = 0
+        # ticks_ms() when the oldest held record was written
+        self.Since = 0
+
+    def Write(self, data):
+        if not self.Held:
+            self.Since = time.ticks_ms()
+        self.Data += data.encode() if isinstance(data, str) else data
+        self.Held += 1
+        if self.Due():
+            self.Flush()
+
+    def Due(self):
+        return self.Held and (self.Held >= self.MaxRecords or time.ticks_diff(time.ticks_ms(), self.Since) >= self.MaxSeconds * 1000)
+
+    def Flush(self):
+        if not self.Held:
+            return
+        Start = time.ticks_us()
+        try:
+            self.Target(self.Data)
         except Exception as e:
-            await Notification(str(e))
-            print("Error truncating file, " + str(e))
+            # Keep the records to try again, unless the backlog is getting too big to hold
+            Count("flush_error", self.Name)
+            print("Error writing " + self.Name + " log, " + str(e))
+            if self.Held < self.MaxRecords * 4:
+                return
+        self.Data = bytearray()
+        self.Held = 0
+        Observe("flush", Start, self.Name)
+
+    # Fixed-size records not yet written, oldest first, as they were when called
+    # (a write or flush while the caller awaits doesn't shift the rest)
+    def Records(self, Size):
+        Data = bytes(self.Data)
+        for Offset in range(0, len(Data) - Size + 1, Size):
+            yield Data[Offset:Offset + Size]
+
+# Notification lines go to their own segments, rolled over as soon as one is full
+def AppendNotifications(data):
+    NotificationLog.Append(data)
+    NotificationLog.Rotate()
+
+SampleBuffer = WriteBehind("samples", SampleLog.Append, BufferRecords, BufferSeconds)
+NotificationBuffer = WriteBehind("notifications", AppendNotifications, BufferRecords, BufferSeconds)
+Buffers = (SampleBuffer, NotificationBuffer)
+
+# Free memory below which held log writes are flushed at once
+LowMemory = 16 * 1024
+
+def FlushAll():
+    for buffer in Buffers:
+        buffer.Flush()
+
+# Flush buffers that have waited long enough, or all of them when memory runs low
+def FlushDue():
+    Low = gc.mem_free() < LowMemory
+    for buffer in Buffers:
+        if Low or buffer.Due():
+            buffer.Flush()
+
+async def FlushBehind():
+    while True:
+        await asyncio.sleep(5)
+        FlushDue()
+
+# Sparse time index over a log of fixed-size records starting with their epoch
+## Keeps the epoch of every "Every"-th record per segment, so a time range is found with a few seeks instead of a full scan
+## Records "Usable" turns down (e.g., unsynced, with out of order epochs) take the epoch before them,
+## so entries never go backwards and the binary search holds
+class TimeIndex:
+    def __init__(self, store, RecordSize, Every, Usable):
+        self.Store = store
+        self.RecordSize = RecordSize
+        self.Every = Every
+        self.Usable = Usable
+        # Segment sequence: epochs of records 0, Every, 2*Every, ...
+        self.Entries = {}
+
+    # Index records written since the last query, forget deleted segments
+    def Refresh(self):
+        for Sequence in list(self.Entries):
+            if Sequence not in self.Store.Segments:
+                del self.Entries[Sequence]
+        Buffer = bytearray(self.RecordSize)
+        Last = 0
+        for Sequence in self.Store.Segments:
+            Entries = self.Entries.get(Sequence)
+            if Entries is None:
+                Entries = self.Entries[Sequence] = array('I')
+            if Entries:
+                Last = Entries[-1]
+            try:
+                Records = os.stat(self.Store.Name(Sequence))[6] // self.RecordSize
+            except OSError:
+                continue
+            if len(Entries) * self.Every >= Records:
+                continue
+            with open(self.Store.Name(Sequence), "rb") as f:
+                for Record in range(len(Entries) * self.Every, Records, self.Every):
+                    f.seek(Record * self.RecordSize)
+                    f.readinto(Buffer)
+                    if self.Usable(Buffer):
+                        Last = max(Last, struct.unpack_from("<I", Buffer)[0])
+                    Entries.append(Last)
+
+    # Segment position and record number to start reading from to reach epoch "From"
+    def Seek(self, From):
+        self.Refresh()
+        Segments = self.Store.Segments
+        Position = 0
+        for n in range(len(Segments)):
+            Entries = self.Entries.get(Segments[n])
+            if Entries and Entries[0] <= From:
+                Position = n
+        Entries = self.Entries.get(Segments[Position])
+        if not Entries:
+            return Position, 0
+        # Binary search for the last index entry at or before "From"
+        Low, High = 0, len(Entries) - 1
+        while Low < High:
+            Middle = (Low + High + 1) // 2
+            if Entries[Middle] <= From:
+                Low = Middle
+            else:
+                High = Middle - 1
+        return Position, Low * self.Every
+
+SampleIndex = TimeIndex(SampleLog, SampleSize, 64, RecordUsable)
+
+# Recover both logs at start, a batch can be cut short by a power cut (e.g., a flat battery)
+## Samples are checked by checksum (up to the most records a write-behind buffer can hold),
+## notifications by ending with a whole line
+def RecoverLogs():
+    Damaged = SampleLog.Recover(SampleSize, RecordValid, BufferRecords * 4)
+    if NotificationLog.Recover(1, lambda last: last[0] == 10, 1):
+        Damaged += 1
+    if Damaged:
+        Count("log_recovered")
+        print("Damaged end of log found, continuing in a new segment")
+    return Damaged
+
+RecoverLogs()
+
+# Stored samples with From <= epoch <= To, oldest first, starting from the time index
+def SampleRange(From, To):
+    Position, Record = SampleIndex.Seek(From)
+    Buffer = bytearray(SampleSize)
+    for Sequence in SampleLog.Segments[Position:]:
+        try:
+            f = open(SampleLog.Name(Sequence), "rb")
+        except OSError:
+            continue
+        with f:
+            f.seek(Record * SampleSize)
+            while f.readinto(Buffer) == SampleSize:
+                if not RecordUsable(Buffer):
+                    continue
+                sample = UnpackSample(Buffer, True)
+                if sample[0] > To:
+                    return
+                if sample[0] >= From:
+                    yield sample
+        Record = 0
+    for record in SampleBuffer.Records(SampleSize):
+        if not RecordUsable(record):
+            continue
+        sample = UnpackSample(record, True)
+        if sample[0] > To:
+            return
+        if sample[0] >= From:
+            yield sample
+
+# Average samples into buckets of "Step" seconds, each stamped with the start of its bucket
+## Readings are counted separately, a missing (None) one is left out and a bucket without any is None
+def Downsample(samples, Step):
+    Bucket = None
+    Sums = [0, 0, 0, 0]
+    Counts = [0, 0, 0, 0]
+    for sample in samples:
+        Start = sample[0] - sample[0] % Step
+        if Start != Bucket:
+            if Counts[0]:
+                yield (Bucket,) + tuple(round(Sums[n] / Counts[n], 2) if Counts[n] else None for n in range(4))
+            Bucket = Start
+            Sums = [0, 0, 0, 0]
+            Counts = [0, 0, 0, 0]
+        for n in range(4):
+            if sample[n + 1] is not None:
+                Sums[n] += sample[n + 1]
+                Counts[n] += 1
+    if Counts[0]:
+        yield (Bucket,) + tuple(round(Sums[n] / Counts[n], 2) if Counts[n] else None for n in range(4))
+
+# Split "a=1&b=2" into a dictionary of strings
+def ParseQuery(Query):
+    Params = {}
+    for pair in Query.split("&"):
+        if "=" in pair:
+            key, value = pair.split("=", 1)
+            Params[key] = value
+    return Params
+
+# Machine-readable samples: /api/samples?from=&to=&step=&format=json|csv
+## "from" and "to" are epoch seconds (negative means seconds before now), default is the last 24 hours
+## "step" averages samples into buckets of that many seconds
+async def SendSamples(writer, request):
+    Params = request["query"]
+    try:
+        Time = Now()
+        To = int(Params.get("to", Time))
+        From = int(Params.get("from", -86400))
+        if To < 0:
+            To = Time + To
+        if From < 0:
+            From = Time + From
+        Step = int(Params.get("step", 0))
+        Format = Params.get("format", "json")
+        if Format not in ("json", "csv"):
+            raise ValueError(Format)
+    except ValueError:
+        await SendStatus(writer, "400 Bad Request")
+        return
+    samples = SampleRange(From, To)
+    if Step > 0:
+        samples = Downsample(samples, Step)
+    if Format == "csv":
+        writer.write("HTTP/1.0 200 OK\r\nContent-type: text/csv\r\n\r\ntime,soil,light,temperature,humidity\n")
+        Row, Separator, End, Missing = "{},{},{},{},{}\n", "", "", ""
+    else:
+        writer.write('HTTP/1.0 200 OK\r\nContent-type: application/json\r\n\r\n{"fields":["time","soil","light","temperature","humidity"],"samples":[')
+        Row, Separator, End, Missing = "[{},{},{},{},{}]", ",", "]}", "null"
+    Lines = 0
+    for sample in samples:
+        writer.write((Separator if Lines else "") + Row.format(sample[0], sample[1], sample[2], *[Missing if value is None else FormatWhole(value) for value in sample[3:]]))
+        Lines += 1
+        # Send in batches to keep the socket buffer small
+        if Lines % 32 == 0:
+            await Drain(writer)
+    writer.write(End)
+    await Drain(writer)
+
+# Roll the log over to a fresh segment when capacity is reached
+async def Truncate(store):
+    Start = time.ticks_us()
+    try:
+        Rolled = store.Rotate()
+        Observe("truncate", Start)
+        if Rolled:
+            Count("log_rollover")
+            print("Rolled over log to " + store.Active())
+    except Exception as e:
+        await Notification(str(e), LevelError, "log")
+        print("Error rolling over log, " + str(e))
+
+# Samples taken before the first sync are held back from flash, up to UnsyncedHold records (2 hours at the "high"
+## rate), so the log only gets them once their time is known; a power cut before the sync loses the held ones
+## Beyond that the oldest go to flash still marked "FlagUnsynced", where readers skip them
+UnsyncedHold = 240
+HeldUnsynced = bytearray()
+## Held records moved on to the write-behind buffer, unsynced
+UnsyncedSpilled = 0
+
+def HoldUnsynced(Record):
+    global HeldUnsynced, UnsyncedSpilled
+    HeldUnsynced += Record
+    if len(HeldUnsynced) > UnsyncedHold * SampleSize:
+        SampleBuffer.Write(HeldUnsynced[:SampleSize])
+        HeldUnsynced = HeldUnsynced[SampleSize:]
+        UnsyncedSpilled += 1
+
+# Notification lines made before the first sync are held the same way, up to UnsyncedNotes lines, and moved by
+## the sync step before they go to the write-behind buffer; beyond that the oldest go with their unsynced time
+UnsyncedNotes = 20
+HeldNotes = []
+
+def HoldNotification(Line):
+    HeldNotes.append(Line)
+    if len(HeldNotes) > UnsyncedNotes:
+        NotificationBuffer.Write(HeldNotes.pop(0))
+
+# Move unsynced packed records in "Data" by "Step" seconds and mark them as synced
+def FixRecords(Data, Step):
+    for Offset in range(0, len(Data) - SampleSize + 1, SampleSize):
+        Flags = Data[Offset + SampleSize - 2]
+        if Flags & FlagUnsynced:
+            struct.pack_into("<I", Data, Offset, struct.unpack_from("<I", Data, Offset)[0] + Step)
+            Data[Offset + SampleSize - 2] = Flags & ~FlagUnsynced
+            Data[Offset + SampleSize - 1] = Checksum(memoryview(Data)[Offset:Offset + SampleSize])
+
+# Correct what is still in memory from before the first sync by the step the sync made
+## Samples in memory, held back and in the write-behind buffer are moved (and no longer marked), with their
+## table rows, as are the notifications made before the sync
+## The held samples then go to the log; if unsynced ones had already gone to flash, a new segment is started
+## so synced records are never mixed in after them
+UnsyncedSamples = 0
+
+def FixUnsynced(Step):
+    global UnsyncedSamples, NotificationLogs, HeldUnsynced, UnsyncedSpilled
+    Held = len(StoredInstances)
+    for n in range(Held - min(UnsyncedSamples, Held), Held):
+        StoredInstances.Columns[0][StoredInstances.Index(n)] += Step
+        if Held - 1 - n < len(LogTable):
+            LogTable.Set(Held - 1 - n, TableRow(StoredInstances.Row(n)))
+    UnsyncedSamples = 0
+    FixRecords(SampleBuffer.Data, Step)
+    FixRecords(HeldUnsynced, Step)
+    if UnsyncedSpilled:
+        SampleBuffer.Flush()
+        SampleLog.Rotate(True)
+        UnsyncedSpilled = 0
+    for Offset in range(0, len(HeldUnsynced), SampleSize):
+        SampleBuffer.Write(HeldUnsynced[Offset:Offset + SampleSize])
+    HeldUnsynced = bytearray()
+    for Line in HeldNotes:
+        Epoch, Rest = Line.split(",", 1)
+        NotificationBuffer.Write(str(int(Epoch) + Step) + "," + Rest)
+    HeldNotes.clear()
+    Notes = list(NotificationLogs)
+    for n in range(max(0, len(Notes) - NotificationCount), len(Notes)):
+        Notes[n] = (Notes[n][0] + Step,) + Notes[n][1:]
+    NotificationLogs = deque(Notes, 10)
+    for Window in Coalescing.values():
+        Window[0] += Step
+    Fragments.Clear()
+
+# Warm start: the in-memory buffers are refilled at start-up from the end of the logs, so pages are full straight away
+## The sample ring, logs table and per-minute rollup come from the last WarmRecords samples (6 hours at the "high"
+## rate, about 10 KiB of a 2 MiB log), the notification list from the last few KiB of notifications
+## Per-hour buckets go back 7 days, too far to re-read, so each one is added to "RollupFile" (56 bytes) once its hour
+## is complete, and only the hour since is re-read from the log
+## The file is rewritten with just the held buckets when it reaches twice as many, or its end was cut short
+WarmRecords = 720
+WarmNotificationBytes = 2048
+RollupFile = "rollup.bin"
+RollupBucketSize = struct.calcsize(RollupBucket)
+
+# Rewrite the file with the held per-hour buckets, to a temporary file renamed so a power cut never leaves half a file
+def WriteRollup():
+    with open(RollupFile + ".tmp", "wb") as f:
+        for Slot in HourRollup.Order():
+            f.write(HourRollup.PackBucket(Slot))
+    os.rename(RollupFile + ".tmp", RollupFile)
+
+# Add the newest per-hour bucket to the file, once it is complete
+def SaveRollup():
+    Start = time.ticks_us()
+    try:
+        with open(RollupFile, "ab") as f:
+            f.write(HourRollup.PackBucket((HourRollup.Head - 1) % HourRollup.Slots))
+        if os.stat(RollupFile)[6] >= 2 * HourRollup.Slots * RollupBucketSize:
+            WriteRollup()
+    except OSError as e:
+        Count("snapshot_error")
+        print("Error saving rollup, " + str(e))
+        return
+    Observe("snapshot", Start)
+
+# Put the saved per-hour buckets back, returning the epoch they cover up to (None without any)
+def LoadRollup():
+    try:
+        Length = os.stat(RollupFile)[6]
+    except OSError:
+        return None
+    Whole = Length // RollupBucketSize
+    Buffer = bytearray(RollupBucketSize)
+    with open(RollupFile, "rb") as f:
+        f.seek(max(0, Whole - HourRollup.Slots) * RollupBucketSize)
+        while f.readinto(Buffer) == RollupBucketSize:
+            HourRollup.LoadBucket(Buffer)
+    if Length % RollupBucketSize or Whole >= 2 * HourRollup.Slots:
+        WriteRollup()
+    if HourRollup.Count:
+        return HourRollup.Newest() + HourRollup.Width
+
+# Older versions kept every sample as a line of "logfile.csv" (time, date, soil, light, temperature, humidity)
+## At the first start-up with segments it is imported into the (empty) log and deleted, as much of its newest part
+## as fits next to it in the free space, leaving the reserved 10%
+LegacyLog = "logfile.csv"
+
+## Returns a message saying how many were imported, None when there was nothing to do
+def ImportLegacyLog():
+    try:
+        os.stat(LegacyLog)
+    except OSError:
+        return None
+    # Imported samples must come before logged ones, so only an empty log is filled
+    for Sequence in SampleLog.Segments:
+        try:
+            if os.stat(SampleLog.Name(Sequence))[6]:
+                print(LegacyLog + " not imported, the log already has samples")
+                return None
+        except OSError:
+            pass
+    Start = time.ticks_us()
+    Stat = os.statvfs("/")
+    Space = min(Stat[0] * Stat[4] - int(SystemSpace * 0.1 * 1024), SampleLog.SegmentSize * SampleLog.SegmentCount)
+    with open(LegacyLog) as f:
+        Lines = sum(1 for line in f)
+    Skip = Lines - max(0, Space) // SampleSize
+    Imported = 0
+    Batch = bytearray()
+    with open(LegacyLog) as f:
+        for n, line in enumerate(f):
+            if n < Skip:
+                continue
+            try:
+                Clock, Date, soil, light, temperature, humidity = line.strip().split(",")
+                Hour, Minute, Second = Clock.split(":")
+                Day, Month, Year = Date.split("/")
+                Epoch = time.mktime((int(Year), int(Month), int(Day), int(Hour), int(Minute), int(Second), 0, 0))
+                Batch += PackSample((Epoch, float(soil), float(light), float(temperature), float(humidity)))
+            except (ValueError, OverflowError):
+                continue
+            Imported += 1
+            if len(Batch) >= 64 * SampleSize:
+                SampleLog.Append(Batch)
+                SampleLog.Rotate()
+                Batch = bytearray()
+    if Batch:
+        SampleLog.Append(Batch)
+        SampleLog.Rotate()
+    os.remove(LegacyLog)
+    Observe("legacy_import", Start)
+    return "Imported " + str(Imported) + " of " + str(Lines) + " samples from " + LegacyLog
+
+# Render the logs table again from the samples in memory
+def RenderTable():
+    LogTable.Clear()
+    for sample in StoredInstances.Rows(TableRows):
+        LogTable.Append(TableRow(sample))
+
+def WarmStart():
+    global NotificationLogs
+    Imported = ImportLegacyLog()
+    Start = time.ticks_us()
+    try:
+        Until = LoadRollup()
+    except OSError:
+        Until = None
+    # Samples logged before the clock was set have no real time, so they are left out
+    for record in SampleLog.Tail(SampleSize, WarmRecords):
+        if not RecordUsable(record):
+            continue
+        sample = UnpackSample(record)
+        StoredInstances.Append(sample, record[SampleSize - 2] & FlagDHTStale)
+        Stale = record[SampleSize - 2] & FlagDHTStale
+        MinuteRollup.Update(sample, Stale)
+        if Until is None or sample[0] >= Until:
+            HourRollup.Update(sample, Stale)
+    RenderTable()
+    Notes = []
+    for line in NotificationLog.TailLines(10, WarmNotificationBytes):
+        try:
+            Epoch, Level, Source, message = line.decode().split(",", 3)
+            Notes.append((int(Epoch), LevelNames.index(Level), message))
+        except ValueError:
+            pass
+    NotificationLogs = deque(Notes, 10)
+    if Imported:
+        StoreNotification(Now(), LevelInfo, "log", Imported)
+    Observe("warm_start", Start)
+    print("Warm start: " + str(len(StoredInstances)) + " samples, " + str(len(Notes)) + " notifications")
 
 # Call to write to file every specified number of seconds
-async def DataRegister(FileName, WriteMode, FrequencySeconds):
+async def DataRegister(store, FrequencySeconds):
+    global UnsyncedSamples
     ## Initialization as interface notification
-    await Notification("Started sensor logging")
+    await Notification("Started sensor logging", LevelInfo, "log")
     
-    ## Globals store values for all functions to access
-    ### CSVArrangement = Basic string of sensor values (1 line)
-    global CSVArrangement
-    ### WebLayout = Store pre-compiled HTML parts with formatting, to lower overall latency
-    global WebLayout
-    ### StoredInstances = Append collected sensor values and truncate the oldest line to conserve system memory
-    global StoredInstances
-    StoredInstances = []
+    ## Give the DHT reader a moment for its first reading, rather than logging an empty one
+    ## In low-power mode there is no reader task and the DHT11 is read with each sample
+    if not LowPower():
+        try:
+            await asyncio.wait_for(DHTReady.wait(), DHTInterval * 3)
+        except asyncio.TimeoutError:
+            pass
     
     while True:
         try:
-            # Create file on system for permanent storage
-            WriteCSV = open(FileName, WriteMode)
-            
-            ## Add arrangement of data to file
-            CSVArrangement = await Juncture()
-            WriteCSV.write(CSVArrangement)
-            
-            ## Create new line in CSV file for each new input
-            WriteCSV.write("\n")
+            if LowPower():
+                await ReadDHT()
+            ## Add packed sample to the log, held in memory and written to flash with the next batch
+            Sample = await Juncture()
+            Start = time.ticks_us()
+            Synced = TimeSynced.is_set()
+            Stale = LatestDHT()[2]
+            Record = PackSample(Sample, (FlagDHTStale if Stale else 0) | (0 if Synced else FlagUnsynced))
+            if Synced:
+                SampleBuffer.Write(Record)
+            else:
+                HoldUnsynced(Record)
+            Observe("log_write", Start)
             print("logged")
             
-            # Populate global variable with formatted data
-            WebLayout = await ReformatWithHTML()
-            
-            ## Affix data to memory, delete oldest instance when MAX number of lines reached
-            UpdateList(CSVArrangement, 20, StoredInstances)
+            ## Affix data to memory, overwriting the oldest sample when the ring is full
+            StoredInstances.Append(Sample, Stale)
+            # Rollups are by time, so only take samples with a synced time
+            if Synced:
+                MinuteRollup.Update(Sample, Stale)
+                # Save the per-hour buckets for the next start-up as each hour is complete
+                if HourRollup.Count and Sample[0] >= HourRollup.Newest() + HourRollup.Width:
+                    SaveRollup()
+                HourRollup.Update(Sample, Stale)
+            else:
+                UnsyncedSamples += 1
+            Row = TableRow(StoredInstances.Latest())
+            LogTable.Append(Row)
+            # Send the new sample to open pages
+            if Subscribers:
+                Publish("sample", json.dumps({"sample": StoredInstances.Latest(), "latest": Fragments.Get("latest", StoredInstances.Appended, ReformatWithHTML).decode(), "row": Row.decode()}))
+            # Wake the actuator to act on the new sample
+            NewSample.set()
             
-            # Delete the OLD data in CSV file when capacity is critical, then "roll-over" most recent data
-            await Truncate("logfile.csv")
+            # Start a new segment when the current one is full, dropping the oldest segment
+            await Truncate(store)
             
             # Asynchronous sleep according to specified interval, let other tasks continue
-            await asyncio.sleep(FrequencySeconds)
+            # (or lightsleep in low-power mode)
+            await Rest(Seconds(FrequencySeconds))
             
         # Have system errors (exceptions) show up in the debug console
         except Exception as e:
             # Write notification to file
-            await Notification(str(e))
+            await Notification(str(e), LevelError, "log")
             print ("Logging stopped unexpectedly: " + str(e))
             break
-        # Do these actions regardless
-        finally:
-            # Close file instance to conserve memory
-            WriteCSV.close()
-
-# Take values in String format and put back into list data structure
-def SplitListByComma(aString):
-    aList = aString
-    # Erase new line and split into values on any comma (String to List)
-    aList = aString.strip('\n').split(',')
-    return aList
-
-# Take global value "CSVArrangement" and format nicely for the main pages
-async def ReformatWithHTML():
-    MakeList = SplitListByComma(CSVArrangement)
-    MakeList[0] = "<li> Time reported at: " + MakeList[0] + ' (UTC)</li>'
-    MakeList[1] = "<li> Date reported at: " + MakeList[1] + ' (D/M/Y) </li>'
-    MakeList[2] = "<li> Soil dryness: " + MakeList[2] + '%</li>'
-    MakeList[3] = "<li> Light levels: " + MakeList[3] + '%</li>'
-    MakeList[4] = "<li> Temperature: " + MakeList[4] + ' C</li>'
-    MakeList[5] = "<li> Relative humidity: " + MakeList[5] + '%</li>'
+
+# Take the latest stored sample and format nicely for the main pages
+def ReformatWithHTML():
+    if not len(StoredInstances):
+        return ""
+    Latest = StoredInstances.Latest()
+    MakeList = [FormatTime(Latest[0])] + ReadingFields(Latest)
+    MakeList[0] = "<li> Reported at: " + MakeList[0] + '</li>'
+    MakeList[1] = "<li> Soil dryness: " + MakeList[1] + '%</li>'
+    MakeList[2] = "<li> Light levels: " + MakeList[2] + '%</li>'
+    MakeList[3] = "<li> Temperature: " + (MakeList[3] + ' C' if MakeList[3] else "no reading") + '</li>'
+    MakeList[4] = "<li> Relative humidity: " + (MakeList[4] + '%' if MakeList[4] else "no reading") + '</li>'
     # Join the list as String-type HTML
     return (''.join(MakeList))
 
 # Relay value "0" means ON, 1 is OFF, Relay
 async def RelayControl(RelayName, delay):
+    global KeepAwake
     # Prevent relay being turned on successively
     if RelayName() == 0:
         print("already activated")
     else:
         RelayName.value(0)
-        await asyncio.sleep(delay)
+        # Stay awake to turn it off on time
+        KeepAwake += 1
+        try:
+            await asyncio.sleep(delay)
+        finally:
+            KeepAwake -= 1
         message = ("Relay " + str(RelayName) + " was turned on for " + str(delay) + " seconds.")
         # Message is one line stored in CSV file
         # comma could create new columns
         message = message.replace(',', '')
-        await Notification(message)
+        await Notification(message, LevelInfo, "relay")
         RelayName.value(1)
 
-# Store system events as notifications in memory as global variable
-NotificationLogs = []
-
-
-async def Notification(message):
-    D = GetDate()
-    T = GetTime()
-    # Re-use "UpdateList" variable to structure log keeping with a line limit
-    UpdateList(str(D + " " + T + " " + message), 10, NotificationLogs)
-    # Put events here in named system file
-    with open ("notifications.csv","a") as f:
-        f.write(str(D + " " + T + " " + message))
-        f.write("\n")
-
-# Detect when to pause actuators in abscence of (day)light
-async def WaitUntilDawn():
-    while float(GetSensorData(Light_Pin)) < 5:
-        print("Pausing actuators until dawn")
-        # Interval to check for light
-        await asyncio.sleep(600)
-    # Close while loop and resume other tasks
-    print("Dawn has been reached")
+# Notifications of system events, each with a severity level and the part of the system it came from (its source)
+LevelInfo = 0
+LevelWarning = 1
+LevelError = 2
+LevelNames = ("info", "warning", "error")
+## Repeats of a message from the same source within CoalesceSeconds are counted rather than stored, and summed up
+## in one notification when the time is up (e.g., "No reading from DHT module ×37 more in last 60 min")
+CoalesceSeconds = 3600
+## Most messages counted at once, the oldest is summed up early beyond this
+MaxCoalescing = 16
+## Each source can store RateBurst notifications in a row, then one per RateSeconds, the rest are counted as suppressed
+RateBurst = 5
+RateSeconds = 120
+
+# Most recent notifications in memory as (epoch, level, message), the oldest dropped beyond 10
+NotificationLogs = deque((), 10)
+# Notifications made since boot (used to tell when cached pages are out of date)
+NotificationCount = 0
+# Message being counted ("source:message"): [epoch first seen, repeats, level, source, message]
+Coalescing = {}
+# Source: [notifications allowed now, ticks_ms() last topped up, suppressed]
+RateLimits = {}
+
+# A notification as shown on pages, e.g., "2023-12-13T13:59:59Z WARNING: No reading from DHT module"
+def NotificationText(item):
+    return FormatTime(item[0]) + " " + (LevelNames[item[1]].upper() + ": " if item[1] else "") + item[2]
+
+# Keep one notification in memory, send it to open pages and to flash (held in the write-behind buffer)
+def StoreNotification(Epoch, Level, Source, message):
+    global NotificationCount
+    NotificationLogs.append((Epoch, Level, message))
+    NotificationCount += 1
+    Publish("notification", json.dumps(NotificationText((Epoch, Level, message))))
+    # One line per notification: epoch, level, source, message
+    Line = str(Epoch) + "," + LevelNames[Level] + "," + Source + "," + message.replace("\n", " ") + "\n"
+    if TimeSynced.is_set():
+        NotificationBuffer.Write(Line)
+    else:
+        HoldNotification(Line)
+
+# Whether a source may store another notification now, counting it as suppressed if not
+def RateAllows(Source):
+    Ticks = time.ticks_ms()
+    Bucket = RateLimits.get(Source)
+    if Bucket is None:
+        Bucket = RateLimits[Source] = [RateBurst, Ticks, 0]
+    Bucket[0] = min(RateBurst, Bucket[0] + time.ticks_diff(Ticks, Bucket[1]) / (RateSeconds * 1000))
+    Bucket[1] = Ticks
+    if Bucket[0] < 1:
+        Bucket[2] += 1
+        return False
+    Bucket[0] -= 1
+    return True
+
+# Stop counting a message, storing how often it was repeated (if it was)
+def CloseCoalescing(Key, Epoch):
+    Window = Coalescing.pop(Key)
+    if Window[1]:
+        Minutes = max(1, (Epoch - Window[0]) // 60)
+        StoreNotification(Epoch, Window[2], Window[3], Window[4] + " ×" + str(Window[1]) + " more in last " + str(Minutes) + " min")
+
+async def Notification(message, Level=LevelInfo, Source="system"):
+    Start = time.ticks_us()
+    Epoch = Now()
+    Key = Source + ":" + message
+    Window = Coalescing.get(Key)
+    if Window is not None:
+        if Epoch - Window[0] < CoalesceSeconds:
+            Window[1] += 1
+            Count("notification_repeat", Source)
+            return
+        CloseCoalescing(Key, Epoch)
+    if not RateAllows(Source):
+        Count("notification_suppressed", Source)
+        return
+    Bucket = RateLimits[Source]
+    if Bucket[2]:
+        StoreNotification(Epoch, LevelWarning, Source, str(Bucket[2]) + " notifications from " + Source + " suppressed")
+        Bucket[2] = 0
+    StoreNotification(Epoch, Level, Source, message)
+    if len(Coalescing) >= MaxCoalescing:
+        Oldest = min(Coalescing, key=lambda k: Coalescing[k][0])
+        CloseCoalescing(Oldest, Epoch)
+    Coalescing[Key] = [Epoch, 0, Level, Source, message]
+    Observe("notification", Start)
+
+# Sum up repeated messages once their time is up, and report suppressed notifications
+## once their source is allowed to store one again
+async def NotificationWatch():
+    while True:
+        await asyncio.sleep(60)
+        Epoch = Now()
+        for Key in [Key for Key in Coalescing if Epoch - Coalescing[Key][0] >= CoalesceSeconds]:
+            CloseCoalescing(Key, Epoch)
+        for Source in RateLimits:
+            if RateLimits[Source][2] and RateAllows(Source):
+                StoreNotification(Epoch, LevelWarning, Source, str(RateLimits[Source][2]) + " notifications from " + Source + " suppressed")
+                RateLimits[Source][2] = 0
+
+# Actuator rules, checked against every new sample from "DataRegister()"
+## A rule turns on when "On" holds and stays on until "Off" holds, so readings hovering around
+## a threshold don't switch it back and forth (hysteresis)
+## While on, "Action" runs at most once per "Duration" plus "Cooldown" seconds: relays stay on for
+## their duration and then off for at least the cooldown, alerts repeat after the cooldown
+## Durations and cooldowns may be functions, read when the rule runs so configuration changes apply
+def Seconds(value):
+    return value() if callable(value) else value
+
+class Rule:
+    def __init__(self, Name, On, Off, Action, Duration=0, Cooldown=0, Daylight=False, UsesDHT=False):
+        self.Name = Name
+        self.On = On
+        self.Off = Off
+        self.Action = Action
+        self.Duration = Duration
+        self.Cooldown = Cooldown
+        # Only run while light is above "DarkAt"
+        self.Daylight = Daylight
+        # Not checked while the DHT reading is stale
+        self.UsesDHT = UsesDHT
+        self.Active = False
+        self.NextRun = None
+    
+    # Sample is (epoch, soil, light, temperature, humidity), as stored in "StoredInstances"
+    def Evaluate(self, Sample, Stale):
+        if self.UsesDHT and Stale:
+            return False
+        if self.Active:
+            if self.Off(Sample):
+                self.Active = False
+                return False
+        elif self.On(Sample):
+            self.Active = True
+        else:
+            return False
+        if self.Daylight and Sample[2] < DarkAt:
+            return False
+        Now = time.ticks_ms()
+        if self.NextRun is not None and time.ticks_diff(self.NextRun, Now) > 0:
+            return False
+        self.NextRun = time.ticks_add(Now, int((Seconds(self.Duration) + Seconds(self.Cooldown)) * 1000))
+        Count("rule_run", self.Name)
+        asyncio.create_task(self.Action(Sample))
+        return True
+
+Rules = [
+    # Watering soil on Relay1
+    Rule("water",
+         lambda s: s[1] > WaterSoilAt,
+         lambda s: s[1] <= WaterSoilAt - SoilHysteresis,
+         lambda s: RelayControl(Relay1, WaterForSeconds),
+         lambda: WaterForSeconds, lambda: WaterCooldown, Daylight=True),
+    # Fanning humidity or heat on Relay2
+    Rule("fan",
+         lambda s: s[4] > FanHumidityAt or s[3] > FanTemperatureAt,
+         lambda s: s[4] <= FanHumidityAt - 5 and s[3] <= FanTemperatureAt - 2,
+         lambda s: RelayControl(Relay2, SpinForSeconds),
+         lambda: SpinForSeconds, lambda: FanCooldown, Daylight=True, UsesDHT=True),
+    # Report high or low greenhouse temperatures, repeated every "PollingRate" while they last
+    Rule("temperature_high",
+         lambda s: s[3] > TemperatureHigh,
+         lambda s: s[3] <= TemperatureHigh - 1,
+         lambda s: Notification("Temperature too high: " + FormatWhole(s[3]) + "C", LevelWarning, "climate"),
+         Cooldown=lambda: PollingRate, UsesDHT=True),
+    Rule("temperature_low",
+         lambda s: s[3] < TemperatureLow,
+         lambda s: s[3] >= TemperatureLow + 1,
+         lambda s: Notification("Temperature too low: " + FormatWhole(s[3]) + "C", LevelWarning, "climate"),
+         Cooldown=lambda: PollingRate, UsesDHT=True),
+]
+# At night, only provide one interval of LED lighting, when grow lights are attached
+if Relay3 is not None:
+    Rules.append(Rule("lights",
+         lambda s: s[2] < DarkAt,
+         lambda s: s[2] >= DarkAt + 5,
+         lambda s: RelayControl(Relay3, LightOnSeconds),
+         lambda: LightOnSeconds, 12 * 3600))
+
+# Set by "DataRegister()" after each sample
+NewSample = asyncio.Event()
 
 async def Actuator():
     while True:
-        # Collect current integer values reported
-        R = SplitListByComma(CSVArrangement)
-        aTime = R[0]
-        aDate = R[1]
-        Soil = R[2]
-        Light = R[3]
-        Temp = R[4]
-        Hum = R[5]
-        
-        try:
-            # At night, only provide one interval of LED lighting
-            if int(float(Light)) < 5:
-                print("It's nighttime")
-                ## Allow lights to turn on before pausing actuator functions
-#                 await Notification("Lights engaged")
-#                 await RelayControl(Relay1, int(LightOnSeconds))
-#                 await Notification("Lights disengaged")
-                await WaitUntilDawn()
+        await NewSample.wait()
+        NewSample.clear()
+        Start = time.ticks_us()
+        Sample = StoredInstances.Latest()
+        # Temperature and humidity rules are skipped when the DHT reading is stale
+        Stale = LatestDHT()[2] or Sample[3] is None
+        for rule in Rules:
+            rule.Evaluate(Sample, Stale)
+        Observe("rules", Start)
+
+# Generate data for "uPlot" graphing software: [epoch times, soil, light, temp, hum]
+## "recent" reads every sample in the sample ring, "hours" and "days" the per-minute or per-hour means
+## so the graph stays at a few hundred points whatever the time span
+## Yielded one series at a time so the whole array is never held as one string
+GraphSpans = {"recent": "2 hours", "hours": "6 hours", "days": "7 days"}
+
+def GraphData(Span="recent"):
+    if Span not in GraphSpans:
+        Span = "recent"
+    if Span == "recent":
+        GD = StoredInstances
+        yield "[[" + ",".join(str(value) for value in GD.Values(0)) + "]"
+        for Column in range(1, 5):
+            if Column < 3:
+                yield ",[" + ",".join(str(round(value, 2)) for value in GD.Values(Column)) + "]"
             else:
-                # Watering soil on Relay1
-                if int(float(Soil)) > int(WaterSoilAt):
-                    print ("Dry soil detected, watering")
-                    await RelayControl(Relay1, WaterForSeconds)
-                    
-                # Fanning humidity on Relay2
-                if int(float(Hum)) > 75:
-                    print ("Humidity too high, fanning")
-                    await RelayControl(Relay2, SpinForSeconds)
-                elif int(float(Temp)) > 30:
-                    print ("Temperature too high, fanning")
-                    await RelayControl(Relay2, SpinForSeconds)
-                
-        finally:
-            # Always check if temperature is high or low and report
-            if int(float(Temp)) > TemperatureHigh:
-                print ("Temperature too high, notifying")
-                await Notification("Temperature too high: " + str(Temp) + "C")
-            if int(float(Temp)) < TemperatureLow:
-                print ("Temperature too low, notifying")
-                await Notification("Temperature too low: " + str(Temp) + "C")
-            # Checking interval
-            await asyncio.sleep(PollingRate)
-
-# Generate data for "uPlot" graphing software
-def GraphData():
-    # Copy variable containing data index (many CSV-type lines)
-    GD = StoredInstances
-    # group each sub-list (*) by the column groups and re-integrate 2D array (i.e., rotate)
-    Rotate = [list(GD) for GD in zip(*GD)]
-    
-    # Generate ascending numbers on x-axis representing cycle
-    AxisNumbers = []
-    for n in range(1,21):
-        AxisNumbers.append(n)
-        
-    NewFormat = []
-    # add relevant grouped lists to graph (x-axis numbers, soil, light, temp, hum)
-    NewFormat.insert(0,AxisNumbers)
-    NewFormat.insert(1,Rotate[2])
-    NewFormat.insert(2,Rotate[3])
-    NewFormat.insert(3,Rotate[4])
-    NewFormat.insert(4,Rotate[5])
-    return NewFormat
+                # Stale DHT readings are gaps in the graph
+                yield ",[" + ",".join("null" if Stale else str(round(value, 2)) for value, Stale in zip(GD.Values(Column), GD.StaleFlags())) + "]"
+    else:
+        GD = HourRollup if Span == "days" else MinuteRollup
+        yield "[[" + ",".join(str(value) for value in GD.Times()) + "]"
+        for Reading in range(4):
+            yield ",[" + ",".join("null" if value is None else str(value) for value in GD.Means(Reading)) + "]"
+    yield "]"
+
+# Links to change the time span of the graph on the current page
+def GraphLinks():
+    return "<p>Graph range: " + " | ".join("<a href='?graph=" + Span + "'>" + GraphSpans[Span] + "</a>" for Span in GraphSpans) + "</p>"
+
+# Bucketed min/max/mean of every reading: /api/rollup?tier=minute|hour
+async def SendRollup(writer, request):
+    GD = Rollups.get(request["query"].get("tier", "minute"))
+    if GD is None:
+        await SendStatus(writer, "400 Bad Request")
+        return
+    writer.write('HTTP/1.0 200 OK\r\nContent-type: application/json\r\n\r\n{"width":' + str(GD.Width) + ',"fields":["time","count","min","max","mean"],"readings":["soil","light","temperature","humidity"],"buckets":[')
+    First = True
+    for Slot in GD.Order():
+        Count = GD.Counts[Slot]
+        Values = ",".join("[{},{},{}]".format(round(GD.Minimums[n][Slot], 2), round(GD.Maximums[n][Slot], 2), round(GD.Sums[n][Slot] / GD.Samples(n, Slot), 2)) if GD.Samples(n, Slot) else "null" for n in range(4))
+        writer.write(("" if First else ",") + "[" + str(GD.Starts[Slot]) + "," + str(Count) + "," + Values + "]")
+        First = False
+        await Drain(writer)
+    writer.write("]}")
+    await Drain(writer)
 
 # The BR tag forces a new line in HTML
 def AddHtmlBr(feed):
@@ -381,20 +1792,14 @@ def AddHtmlBr(feed):
 # Makes string adding list tags around a List objects in MicroPython
 # Reasons for using this: https://developer.mozilla.org/en-US/docs/Web/HTML/Element/br#accessibility_concerns
 
+## Yields one notification at a time, to be streamed to the client
 def MakeHTMLList(feed):
-    constructor = ""
     for item in feed:
-        constructor = constructor + "<li>" + ', '.join(map(str, item)) + "</li>"
-    return constructor
+        yield "<li>" + NotificationText(item) + "</li>"
 
-def MakeTableList(feed):
-    constructor = ""
-    for item in feed:
-        constructor = constructor + "<tr>"
-        for item in item:
-            constructor = constructor + "<td>" + item + "</td>"
-        constructor = constructor + "</tr>"
-    return constructor
+## One row of the logs table, rendered as each sample is logged
+def TableRow(sample):
+    return ("<tr><td>" + FormatTime(sample[0]) + "</td><td>" + "</td><td>".join(ReadingFields(sample)) + "</td></tr>").encode()
 
 def TitleChanger(newtitle):
     UpdatedTitle = "<title>" + str(newtitle) + " - Efficient Greenhouse Plant Care system" "</title>"
@@ -433,11 +1838,14 @@ html = """<!DOCTYPE html>
         <li>
         <a role="menuitem" href='/logs/monitor'>Check Notification Activity</a>
         </li>
+        <li>
+        <a role="menuitem" href='/logs/download'>Download Logged Data (CSV)</a>
+        </li>
         </ul>
         
         <br>
         
-        <ul>
+        <ul id="latest">
         <li>
         <strong>
         Sensor Data:
@@ -465,12 +1873,13 @@ html = """<!DOCTYPE html>
         </script>
         
         {eight}     
+        {nine}
     </body>
 </html>
 """
 
+# Served as "/static/app.css"
 css = r"""
-    <style>
     body {
         font-family: sans-serif;
         text-align: center;
@@ -506,7 +1915,6 @@ css = r"""
         display: inline-grid;
         justify-content: center;
     }
-    </style>
 """
 
 # Largely modified boilerplate code
@@ -515,8 +1923,12 @@ css = r"""
 graph = r"""<div class = "graph">
 <link href="https://leeoniya.github.io/uPlot/dist/uPlot.min.css" rel="stylesheet">
 <script src="https://leeoniya.github.io/uPlot/dist/uPlot.iife.min.js"></script>
-		<script>
+		<script src="{}"></script>
+		</div>
+"""
 
+# Served as "/static/graph.js", expects "data" to be set by the page
+graphjs = r"""
 			function getSize() {
 				return {
 					width: window.innerWidth - 100,
@@ -530,7 +1942,7 @@ graph = r"""<div class = "graph">
 				 axes: [
                 {
                   show: true,
-                  label: "Cycle (rightmost newest)",
+                  label: "Time",
                 },
                 {
                   show: true,
@@ -539,7 +1951,7 @@ graph = r"""<div class = "graph">
                 ],
 				scales: {
 					x: {
-						time: false,
+						time: true,
 						// snap x-zoom to exact data values
 						range: (u, min, max) => [
 							data[0][u.valToIdx(min)],
@@ -625,84 +2037,547 @@ graph = r"""<div class = "graph">
 			window.addEventListener("resize", e => {
 				u.setSize(getSize());
 			});
-		</script>
-		</div>
+"""
+
+# Live updates from "/events", added to the same static script
+graphjs += "\n\t\tconst sampleWindow = " + str(SampleWindow) + ";\n" + r"""
+		// Only the "recent" graph is made of single samples, the others are bucketed means
+		const span = new URLSearchParams(location.search).get("graph") || "recent";
+		const events = new EventSource("/events");
+
+		events.addEventListener("sample", e => {
+			const m = JSON.parse(e.data);
+			const latest = document.getElementById("latest");
+			if (latest) {
+				latest.innerHTML = latest.firstElementChild.outerHTML + m.latest;
+			}
+			const table = document.getElementById("logtable");
+			if (table) {
+				table.tBodies[0].insertAdjacentHTML("beforeend", m.row);
+				if (table.rows.length > +table.dataset.rows + 1) {
+					table.deleteRow(1);
+				}
+			}
+			if (span == "recent") {
+				m.sample.forEach((v, i) => data[i].push(v));
+				if (data[0].length > sampleWindow) {
+					data.forEach(s => s.shift());
+				}
+				u.setData(data);
+			}
+		});
+
+		events.addEventListener("notification", e => {
+			const list = document.getElementById("notifications");
+			if (list) {
+				const item = document.createElement("li");
+				item.textContent = JSON.parse(e.data);
+				list.appendChild(item);
+				if (list.children.length > 10) {
+					list.firstElementChild.remove();
+				}
+			}
+		});
 """
 
 # end of uPlot code
 
-async def serve_client(reader, writer):
+# Split a page template on its {name} slots once, into static text and slot names taking turns
+## Static text is kept as bytes, ready to be written to the socket
+def SplitTemplate(template):
+    Parts = []
+    Position = 0
+    while True:
+        Start = template.find("{", Position)
+        if Start < 0:
+            Parts.append(template[Position:].encode())
+            return Parts
+        End = template.find("}", Start)
+        Parts.append(template[Position:Start].encode())
+        Parts.append(template[Start + 1:End])
+        Position = End + 1
+
+PageParts = SplitTemplate(html)
+# Graph span links never change, so are made once
+Links = GraphLinks()
+
+# Styles and graph code are served on their own routes so browsers can cache them
+## Content type and text of each static asset
+StaticAssets = {
+    "/static/app.css": ("text/css", css),
+    "/static/graph.js": ("application/javascript", graphjs),
+}
+StaticFolder = "static"
+# Route: (content type, checksum of the content, path of gzipped copy in flash or None)
+StaticFiles = {}
+# Page parts linking to the static assets, filled in with "StaticURL"
+StyleLink = '<link rel="stylesheet" href="{}">'
+
+# Asset URL with the checksum of its content, so a firmware update changes the URL and browsers fetch the new version
+def StaticURL(route):
+    return route + "?v=" + StaticFiles[route][1] if route in StaticFiles else route
+
+# Gzip a static asset into flash with the "deflate" module, if this firmware can compress
+## Written to a temporary file first so a half-written copy is never served
+def CompressStatic(content, FileName):
     try:
-        print("Client connected")
-        request_line = await reader.readline()
-        print("Request:", request_line)
-        while await reader.readline() != b"\r\n":
+        import deflate
+        with open(FileName + ".tmp", "wb") as f:
+            g = deflate.DeflateIO(f, deflate.GZIP)
+            g.write(content)
+            g.close()
+        os.rename(FileName + ".tmp", FileName)
+        return True
+    except Exception as e:
+        print("Static asset not compressed, " + str(e))
+        try:
+            os.remove(FileName + ".tmp")
+        except OSError:
             pass
+        return False
 
-        request = str(request_line)
-        relay1 = request.find('/relay1/on')
-        relay2 = request.find('/relay2/on')
-        log_URL = request.find('/logs/list')
-        monitor_URL = request.find('/logs/monitor')
-
-        Title = "Home Page"
-        StateIs = ""
-        RequestLogs = ""
-        RequestLogs2 = ""
-        
-        # Mainly test functions for relay setting "moulding"
-        if relay1 == 6:
-            print("relay1 on")
-            StateIs = 'Turned on relay1'
-            await RelayControl(Relay1, 1)
-            print("relay1 off")
-            Title = "Relay 1 has activated page"
-            
-        if relay2 == 6:
-            print("relay2 on")
-            StateIs = 'Turned on relay2'
-            await RelayControl(Relay2, 1)
-            print("relay2 off")
-            Title = "Relay 2 has activated page"
-
-
-        if log_URL == 6:
-            print("requesting logs...")
-            # Change [list] type to [string]
-            StateIs = "<p>Recent sensor logs reported:</p>"
-            RequestLogs = "<table><tr>" + "<th>Time (UTC)</th><th>Date</th><th>Soil dryness, %</th><th>Light levels, %</th><th>Temperature</th><th>Relative Humidity, %</th></tr>" + MakeTableList(StoredInstances) + "</table>"
-            Title = "Logs in a table page"
-            
-        if monitor_URL == 6:
-            StateIs = "Most recent notifications logged by date and time:"
-            RefreshPage = """<script>setTimeout(() => {document.location.reload();},""" + str(LoggingFrequency()*1000) + """);</script>"""
-            RequestLogs2 = MakeHTMLList(NotificationLogs) + RefreshPage
-            Title = "Recent notifications of events page"
-
-        # All data on web page is condensed here
-        response = html .format(one=TitleChanger(Title), two=css, three=WebLayout, four=StateIs, five=RequestLogs, six=RequestLogs2, seven=GraphData(), eight=graph,)
+# Find or make the gzipped copy of each static asset, named by the checksum of its content
+## A gzipped copy can also be uploaded from a computer (e.g., "gzip -k app.css" renamed to match)
+def PrepareStatic():
+    try:
+        os.mkdir(StaticFolder)
+    except OSError:
+        pass
+    Existing = os.listdir(StaticFolder)
+    for route in StaticAssets:
+        ContentType, content = StaticAssets[route]
+        Checksum = "{:08x}".format(binascii.crc32(content.encode()) & 0xffffffff)
+        Name = route[len(StaticFolder) + 2:]
+        FileName = Name + "." + Checksum + ".gz"
+        # Remove copies of older versions of the asset
+        for other in Existing:
+            if other.startswith(Name + ".") and other != FileName:
+                try:
+                    os.remove(StaticFolder + "/" + other)
+                except OSError:
+                    pass
+        Path = StaticFolder + "/" + FileName
+        if FileName not in Existing and not CompressStatic(content, Path):
+            Path = None
+        StaticFiles[route] = (ContentType, Checksum, Path)
+
+# Send a static asset: "304 Not Modified" when the browser already has this version, gzipped from flash if possible
+## Each encoding has its own ETag. Only the URL with the current checksum is cached without asking again,
+## any other is checked with the ETag every time
+async def SendStatic(writer, route, request):
+    ContentType, Checksum, Path = StaticFiles[route]
+    Gzip = Path and request["gzip"]
+    Tag = '"' + Checksum + ('-gz"' if Gzip else '"')
+    Cache = "public, max-age=31536000, immutable" if request["query"].get("v") == Checksum else "no-cache"
+    Headers = "ETag: " + Tag + "\r\nCache-Control: " + Cache + "\r\nVary: Accept-Encoding\r\n"
+    if request["etag"] == Tag:
+        writer.write("HTTP/1.0 304 Not Modified\r\n" + Headers + "\r\n")
+        await Drain(writer)
+        return
+    if Gzip:
+        writer.write("HTTP/1.0 200 OK\r\nContent-type: " + ContentType + "\r\nContent-Encoding: gzip\r\nContent-Length: " + str(os.stat(Path)[6]) + "\r\n" + Headers + "\r\n")
+        Buffer = bytearray(512)
+        with open(Path, "rb") as f:
+            while True:
+                n = f.readinto(Buffer)
+                if not n:
+                    break
+                await SendChunks(writer, Buffer if n == len(Buffer) else Buffer[:n])
+    else:
+        content = StaticAssets[route][1]
+        writer.write("HTTP/1.0 200 OK\r\nContent-type: " + ContentType + "\r\n" + Headers + "\r\n")
+        await SendChunks(writer, content)
+    await Drain(writer)
+
+# Wait for the client to take what has been written, giving up on a stalled connection
+async def Drain(writer):
+    await asyncio.wait_for(writer.drain(), IdleTimeout)
+
+# Page parts made from the logged data, rendered once into a bytearray and sent to every client
+## until the data changes: each fragment is kept with the version it was made from
+## (e.g., "StoredInstances.Appended"), and made again on the first request after the version moves on
+class FragmentCache:
+    def __init__(self):
+        # Name: (version, rendered bytes)
+        self.Fragments = {}
+    
+    # "Render" makes the fragment as a string or a generator of strings
+    def Get(self, Name, Version, Render):
+        Entry = self.Fragments.get(Name)
+        if Entry is not None and Entry[0] == Version:
+            Count("fragment_hit", Name)
+            return Entry[1]
+        # Drop the old copy first so both are never held together
+        self.Fragments.pop(Name, None)
+        Start = time.ticks_us()
+        Rendered = Render()
+        Buffer = bytearray()
+        for piece in ((Rendered,) if isinstance(Rendered, str) else Rendered):
+            Buffer.extend(piece.encode())
+        self.Fragments[Name] = (Version, Buffer)
+        Observe("render", Start, Name)
+        return Buffer
+    
+    # Drop every fragment, for when data changes without a new version
+    def Clear(self):
+        self.Fragments = {}
+
+Fragments = FragmentCache()
+
+# Write one piece of a response: a string, or any (nested) generator of strings
+## Waits for every chunk to be sent, so only one chunk is ever buffered per client
+async def SendChunks(writer, chunk):
+    if isinstance(chunk, (str, bytes, bytearray)):
+        if chunk:
+            writer.write(chunk)
+            await Drain(writer)
+    else:
+        for piece in chunk:
+            await SendChunks(writer, piece)
+
+# Stream the page template, static parts straight from the constant and slots filled from "Slots"
+async def SendPage(writer, Slots, Status="200 OK"):
+    writer.write('HTTP/1.0 ' + Status + '\r\nContent-type: text/html\r\n\r\n')
+    Static = True
+    for part in PageParts:
+        await SendChunks(writer, part if Static else Slots[part])
+        Static = not Static
+
+# Web server limits
+## Clients served at once, extra connections are answered "503 Service Unavailable"
+MaxConnections = 4
+## Seconds to wait for each request line, and for a client to take each chunk of a response
+RequestTimeout = 10
+IdleTimeout = 20
+## Most request headers read from one request
+MaxHeaders = 32
+## Largest request body read (bytes)
+MaxBody = 1024
+Connections = 0
+
+# Read the request line and the headers that are used into a dictionary
+## Returns None for a request that can't be understood
+async def ReadRequest(reader):
+    request_line = await asyncio.wait_for(reader.readline(), RequestTimeout)
+    print("Request:", request_line)
+    RequestParts = request_line.decode().split()
+    if len(RequestParts) < 2:
+        return None
+    Path = RequestParts[1]
+    Query = ""
+    if "?" in Path:
+        Path, Query = Path.split("?", 1)
+    request = {"method": RequestParts[0], "path": Path, "query": ParseQuery(Query), "etag": None, "gzip": False, "body": b""}
+    Length = 0
+    # Only the cache, compression and body length headers are used
+    for n in range(MaxHeaders):
+        header = await asyncio.wait_for(reader.readline(), RequestTimeout)
+        if header == b"\r\n" or not header:
+            break
+        header = header.decode().lower()
+        if header.startswith("if-none-match:"):
+            request["etag"] = header[14:].strip()
+        elif header.startswith("accept-encoding:") and "gzip" in header:
+            request["gzip"] = True
+        elif header.startswith("content-length:"):
+            # A length that isn't a number is a bad request
+            try:
+                Length = int(header[15:].strip() or 0)
+            except ValueError:
+                return None
+            if Length < 0:
+                return None
+    # A body too big to hold is left unread and marked as None
+    if Length > MaxBody:
+        request["body"] = None
+        return request
+    while len(request["body"]) < Length:
+        data = await asyncio.wait_for(reader.read(Length - len(request["body"])), RequestTimeout)
+        if not data:
+            break
+        request["body"] += data
+    return request
+
+async def SendStatus(writer, Status):
+    writer.write("HTTP/1.0 " + Status + "\r\nContent-type: text/plain\r\n\r\n" + Status + "\r\n")
+    await Drain(writer)
+
+# Page handlers, each called with the client stream and the request dictionary
+## The page template is filled from the given parts and streamed, chunk by chunk
+## Latest readings and graph data are taken from the fragment cache
+async def ShowPage(writer, request, Title, StateIs="", RequestLogs="", RequestLogs2="", Status="200 OK"):
+    Span = request["query"].get("graph", "recent")
+    if Span not in GraphSpans:
+        Span = "recent"
+    Version = StoredInstances.Appended
+    await SendPage(writer, {"one": TitleChanger(Title), "two": StyleLink.format(StaticURL("/static/app.css")), "three": Fragments.Get("latest", Version, ReformatWithHTML), "four": StateIs, "five": RequestLogs, "six": RequestLogs2, "seven": Fragments.Get("graph_" + Span, Version, lambda: GraphData(Span)), "eight": graph.format(StaticURL("/static/graph.js")), "nine": Links}, Status)
+
+async def HomePage(writer, request):
+    await ShowPage(writer, request, "Home Page")
+
+# Mainly test functions for relay setting "moulding"
+## The relay runs as a background task, the page is answered "202 Accepted" straight away
+def RelayPage(RelayName, Number):
+    async def Handler(writer, request):
+        print("relay" + Number + " on")
+        asyncio.create_task(RelayControl(RelayName, 1))
+        await ShowPage(writer, request, "Relay " + Number + " has activated page", "Turned on relay" + Number, Status="202 Accepted")
+    return Handler
+
+async def LogsPage(writer, request):
+    print("requesting logs...")
+    # Table rows are rendered as samples are logged, and streamed from the row ring
+    RequestLogs = ('<table id="logtable" data-rows="' + str(TableRows) + '"><tr>' + "<th>Time</th><th>Soil dryness, %</th><th>Light levels, %</th><th>Temperature</th><th>Relative Humidity, %</th></tr>", LogTable.Batches(), "</table>")
+    await ShowPage(writer, request, "Logs in a table page", "<p>Recent sensor logs reported:</p>", RequestLogs)
+
+## New notifications are added by the page script from "/events", without reloading the page
+async def MonitorPage(writer, request):
+    await ShowPage(writer, request, "Recent notifications of events page", "Most recent notifications logged by date and time:", "", ('<ul id="notifications">', Fragments.Get("notifications", NotificationCount, lambda: MakeHTMLList(NotificationLogs)), "</ul>"))
+
+# Export the whole log as CSV, made one line at a time from the packed records
+async def DownloadLogs(writer, request):
+    print("exporting logs...")
+    writer.write('HTTP/1.0 200 OK\r\nContent-type: text/csv\r\nContent-Disposition: attachment; filename="logfile.csv"\r\n\r\n')
+    Lines = 0
+    for sample in ReadSamples(SampleLog, SampleBuffer):
+        writer.write(SampleToCSV(sample) + "\n")
+        Lines += 1
+        # Send in batches to keep the socket buffer small
+        if Lines % 64 == 0:
+            await Drain(writer)
+    await Drain(writer)
+
+# Name of the second label of a timing or counter, after what it holds (a web route unless listed)
+MetricLabels = {"flush": "buffer", "flush_error": "buffer", "notification_repeat": "source", "notification_suppressed": "source",
+                "rule_run": "rule", "fragment_hit": "fragment", "render": "fragment", "event": "type"}
+
+def MetricLabel(Name, Label):
+    return ('",' + MetricLabels.get(Name, "route") + '="' + Label) if Label else ""
+
+# Metrics in the Prometheus text format
+def MetricLines():
+    yield "# TYPE pico_call_seconds summary\n"
+    for Name, Label in Timings:
+        T = Timings[(Name, Label)]
+        Labels = '{call="' + Name + MetricLabel(Name, Label) + '"}'
+        yield "pico_call_seconds_count" + Labels + " " + str(T[0]) + "\n"
+        yield "pico_call_seconds_sum" + Labels + " " + str(T[1] / 1000000) + "\n"
+    yield "# TYPE pico_call_max_seconds gauge\n"
+    for Name, Label in Timings:
+        Labels = '{call="' + Name + MetricLabel(Name, Label) + '"}'
+        yield "pico_call_max_seconds" + Labels + " " + str(Timings[(Name, Label)][2] / 1000000) + "\n"
+    yield "# TYPE pico_events_total counter\n"
+    for Name, Label in Counters:
+        Labels = '{event="' + Name + MetricLabel(Name, Label) + '"}'
+        yield "pico_events_total" + Labels + " " + str(Counters[(Name, Label)]) + "\n"
+    WatchMemory()
+    yield "# TYPE pico_mem_free_bytes gauge\npico_mem_free_bytes " + str(gc.mem_free()) + "\n"
+    yield "# TYPE pico_mem_free_min_bytes gauge\npico_mem_free_min_bytes " + str(Memory["free_min"]) + "\n"
+    yield "# TYPE pico_mem_alloc_max_bytes gauge\npico_mem_alloc_max_bytes " + str(Memory["alloc_max"]) + "\n"
+    yield "# TYPE pico_loop_lag_seconds summary\npico_loop_lag_seconds_count " + str(LoopLag["count"]) + "\npico_loop_lag_seconds_sum " + str(LoopLag["sum_ms"] / 1000) + "\n"
+    yield "# TYPE pico_loop_lag_max_seconds gauge\npico_loop_lag_max_seconds " + str(LoopLag["max_ms"] / 1000) + "\n"
+    yield "# TYPE pico_sensor_percent gauge\n"
+    for Pin in SensorStats:
+        yield 'pico_sensor_percent{pin="' + str(Pin) + '"} ' + str(SensorStats[Pin][0]) + "\n"
+    yield "# TYPE pico_sensor_variance gauge\n"
+    for Pin in SensorStats:
+        yield 'pico_sensor_variance{pin="' + str(Pin) + '"} ' + str(round(SensorStats[Pin][1], 4)) + "\n"
+    Hum, Temp, DHTStale = LatestDHT()
+    yield "# TYPE pico_dht_stale gauge\npico_dht_stale " + str(int(DHTStale)) + "\n"
+    yield "# TYPE pico_dht_failures gauge\npico_dht_failures " + str(DHTReading["failures"]) + "\n"
+    yield "# TYPE pico_connections gauge\npico_connections " + str(Connections) + "\n"
+    yield "# TYPE pico_event_subscribers gauge\npico_event_subscribers " + str(len(Subscribers)) + "\n"
+    yield "# TYPE pico_wifi_connected gauge\npico_wifi_connected " + str(int(NetworkUp.is_set())) + "\n"
+    yield "# TYPE pico_wifi_drops_total counter\npico_wifi_drops_total " + str(WiFi["drops"]) + "\n"
+    yield "# TYPE pico_time_synced gauge\npico_time_synced " + str(int(TimeSynced.is_set())) + "\n"
+    yield "# TYPE pico_time_drift_ppm gauge\npico_time_drift_ppm " + str(TimeSync["drift_ppm"]) + "\n"
+    yield "# TYPE pico_time_sync_failures_total counter\npico_time_sync_failures_total " + str(TimeSync["failures"]) + "\n"
+    Used, Average, Runtime = EnergyBudget()
+    yield "# TYPE pico_power_state_seconds counter\n"
+    for State in Energy:
+        yield 'pico_power_state_seconds{state="' + State + '"} ' + str(Energy[State] / 1000) + "\n"
+    yield "# TYPE pico_energy_used_mah counter\npico_energy_used_mah " + str(round(Used, 3)) + "\n"
+    yield "# TYPE pico_power_average_ma gauge\npico_power_average_ma " + str(round(Average, 2)) + "\n"
+    yield "# TYPE pico_battery_runtime_hours gauge\npico_battery_runtime_hours " + str(round(Runtime, 1)) + "\n"
+    yield "# TYPE pico_uptime_seconds gauge\npico_uptime_seconds " + str(time.ticks_diff(time.ticks_ms(), BootTicks) // 1000) + "\n"
+
+# Live updates for open pages as Server-Sent Events: /events
+## Each new sample ("sample") and notification ("notification") is sent as one JSON message over one
+## long-lived connection, and the page script updates the readings, table, graph and notification list in place
+## Each subscriber holds a connection, so only a few are allowed to leave room for page requests
+MaxSubscribers = 2
+## Messages waiting for a slow subscriber, the oldest is dropped beyond this
+EventBacklog = 8
+## Seconds between keep-alive comments when there is nothing to send
+KeepAlive = 60
+
+class Subscriber:
+    def __init__(self):
+        self.Queue = []
+        self.Ready = asyncio.Event()
+
+Subscribers = []
+
+# Queue a message for every subscriber, never waiting on a client
+def Publish(Name, Data):
+    if not Subscribers:
+        return
+    Message = ("event: " + Name + "\ndata: " + Data + "\n\n").encode()
+    for Client in Subscribers:
+        if len(Client.Queue) >= EventBacklog:
+            Client.Queue.pop(0)
+            Count("event_dropped")
+        Client.Queue.append(Message)
+        Client.Ready.set()
+    Count("event", Name)
+
+async def SendEvents(writer, request):
+    if len(Subscribers) >= MaxSubscribers:
+        Count("request_refused", "/events")
+        writer.write("HTTP/1.0 503 Service Unavailable\r\nRetry-After: " + str(KeepAlive) + "\r\n\r\n")
+        await Drain(writer)
+        return
+    # Browsers reconnect by themselves after "retry" milliseconds if the connection drops
+    writer.write("HTTP/1.0 200 OK\r\nContent-type: text/event-stream\r\nCache-Control: no-cache\r\n\r\nretry: " + str(LoggingFrequency() * 1000) + "\n\n")
+    Client = Subscriber()
+    Subscribers.append(Client)
+    try:
+        await Drain(writer)
+        while True:
+            try:
+                await asyncio.wait_for(Client.Ready.wait(), KeepAlive)
+            except asyncio.TimeoutError:
+                writer.write(": keep-alive\n\n")
+            Client.Ready.clear()
+            while Client.Queue:
+                writer.write(Client.Queue.pop(0))
+            await Drain(writer)
+    # A closed page ends the stream, this is not an error
+    except OSError:
+        pass
+    finally:
+        Subscribers.remove(Client)
+
+# Settings: GET /api/config for the current values (without the password), POST /api/config with
+## a JSON object of settings to change, all validated before any are saved
+async def SendConfig(writer, request):
+    if request["method"] == "POST":
+        try:
+            Changes = json.loads(request["body"]) if request["body"] is not None else None
+        except ValueError:
+            Changes = None
+        Problem = ConfigProblem(Changes) if Changes is not None else "settings must be a JSON object of up to " + str(MaxBody) + " bytes"
+        if not Problem:
+            try:
+                Problem = SaveConfig(Changes)
+            except OSError as e:
+                Count("config_error")
+                await Notification("Settings not saved, " + str(e), LevelError, "config")
+                await SendStatus(writer, "500 Internal Server Error")
+                return
+        if Problem:
+            writer.write("HTTP/1.0 400 Bad Request\r\nContent-type: application/json\r\n\r\n" + json.dumps({"error": Problem}))
+            await Drain(writer)
+            return
+        if Changes:
+            await Notification("Settings changed: " + " ".join(sorted(Changes)), LevelInfo, "config")
+    Settings = dict((Name, globals()[Name]) for Name in ConfigSchema if Name not in ConfigSecrets)
+    writer.write("HTTP/1.0 200 OK\r\nContent-type: application/json\r\nCache-Control: no-store\r\n\r\n" + json.dumps(Settings))
+    await Drain(writer)
+
+async def SendMetrics(writer, request):
+    writer.write("HTTP/1.0 200 OK\r\nContent-type: text/plain; version=0.0.4\r\n\r\n")
+    await SendChunks(writer, MetricLines())
+
+# Request method and path: handler
+Routes = {
+    ("GET", "/"): HomePage,
+    ("GET", "/relay1/on"): RelayPage(Relay1, "1"),
+    ("GET", "/relay2/on"): RelayPage(Relay2, "2"),
+    ("GET", "/logs/list"): LogsPage,
+    ("GET", "/logs/monitor"): MonitorPage,
+    ("GET", "/logs/download"): DownloadLogs,
+    ("GET", "/api/samples"): SendSamples,
+    ("GET", "/api/rollup"): SendRollup,
+    ("GET", "/api/config"): SendConfig,
+    ("POST", "/api/config"): SendConfig,
+    ("GET", "/metrics"): SendMetrics,
+    ("GET", "/events"): SendEvents,
+}
 
-        writer.write('HTTP/1.0 200 OK\r\nContent-type: text/html\r\n\r\n')
-        writer.write(response)
-        
-        await writer.drain()
+async def serve_client(reader, writer):
+    global Connections
+    Start = time.ticks_us()
+    # Requests are timed per route, anything unknown counts as "other"
+    Route = "other"
+    try:
+        # Turn extra clients away at once instead of letting requests pile up
+        if Connections >= MaxConnections:
+            Count("request_refused")
+            print("Client refused, server busy")
+            writer.write("HTTP/1.0 503 Service Unavailable\r\nRetry-After: 5\r\n\r\n")
+            await Drain(writer)
+            return
+        Connections += 1
+        try:
+            print("Client connected")
+            request = await ReadRequest(reader)
+            if request is None:
+                await SendStatus(writer, "400 Bad Request")
+                return
+            Path = request["path"]
+            handler = Routes.get((request["method"], Path))
+            if handler or Path in StaticFiles:
+                Route = Path
+            if handler:
+                await handler(writer, request)
+            elif Path in StaticFiles and request["method"] == "GET":
+                await SendStatic(writer, Path, request)
+            elif Path in StaticFiles or any(route[1] == Path for route in Routes):
+                await SendStatus(writer, "405 Method Not Allowed")
+            else:
+                await SendStatus(writer, "404 Not Found")
+        finally:
+            Connections -= 1
+    except asyncio.TimeoutError:
+        Count("request_timeout")
+        print("Client timed out")
+    except Exception as e:
+        Count("request_error")
+        await Notification(str(e), LevelError, "web")
+    finally:
+        writer.close()
         await writer.wait_closed()
-
+        Observe("request", Start, Route)
         print("Client disconnected")
-    except Exception as e:
-        await Notification(str(e))
 
 
 
 async def main():
     print('Setting up webserver...')
-    task1 = asyncio.create_task(asyncio.start_server(serve_client, "0.0.0.0", 80))
-    # Network reconnect task:
-    task2 = asyncio.create_task(connect2())
-    # Asynchronous logging initiate (file, write type, interval seconds)
-    task3 = asyncio.create_task(DataRegister("logfile.csv","a",LoggingFrequency()))
-    # Routine relay checker and actuator
+    PrepareStatic()
+    # Fill the graph, logs table and notifications from what was logged before the restart
+    WarmStart()
+    # Wi-Fi connection, and the web server while it is up
+    task1 = asyncio.create_task(WiFiManager())
+    task2 = asyncio.create_task(WebServer())
+    # Asynchronous logging initiate (log store, interval seconds, read again every tick)
+    task3 = asyncio.create_task(DataRegister(SampleLog,LoggingFrequency))
+    # Relay actuator, acting on each new sample
     task4 = asyncio.create_task(Actuator())
+    # Keep the clock synced with NTP
+    asyncio.create_task(TimeService())
+    # In low-power mode the DHT11 is read and held records written by "DataRegister()", once per wake,
+    # and loop lag means nothing when the whole loop sleeps
+    if not LowPower():
+        # Background DHT11 reader, sharing its last good reading
+        asyncio.create_task(DHTReader())
+        # Event loop lag and memory high-water marks for "/metrics"
+        asyncio.create_task(WatchLoop())
+        # Write held log records to flash when due
+        asyncio.create_task(FlushBehind())
+    # Sum up repeated and suppressed notifications
+    asyncio.create_task(NotificationWatch())
     
     await task1
     await task2
@@ -710,17 +2585,85 @@ async def main():
     await task4
     
 
-# fallback connect to network without interrupting other services
-async def connect2():
+# Connect to WiFi using credentials, and keep connecting whenever the link drops
+## Sets "NetworkUp"/"NetworkDown" and notifies as the link comes and goes
+## In low-power mode the radio is only powered during serve windows ("RadioWanted")
+def SetWiFiState(State):
+    WiFi["state"] = State
+    print("Wi-Fi " + State)
+
+def RadioPower(wifi, On):
+    Account()
+    wifi.active(On)
+    if On:
+        # Power saving mode off, unless saving power matters more than response times
+        wifi.config(pm = 0xa11142 if LowPower() else 0xa11140)
+    EnergyState["radio"] = On
+
+async def WiFiManager():
     wifi = network.WLAN(network.STA_IF)
+    Retry = ConnectRetry
+    while True:
+        if LowPower() and not RadioWanted.is_set():
+            RadioPower(wifi, False)
+            SetWiFiState("off")
+            Retry = ConnectRetry
+            await RadioWanted.wait()
+        RadioPower(wifi, True)
+        SetWiFiState("connecting")
+        wifi.connect(ssid, password)
+        Deadline = time.ticks_add(time.ticks_ms(), ConnectTimeout * 1000)
+        # Negative status codes are failures (no access point, wrong password)
+        while not wifi.isconnected() and wifi.status() >= 0 and time.ticks_diff(Deadline, time.ticks_ms()) > 0:
+            await asyncio.sleep(1)
+        if wifi.isconnected():
+            SetWiFiState("connected")
+            print(wifi.ifconfig())
+            # on-board RPP LED ON while network is connected
+            led.value(1)
+            WiFi["connects"] += 1
+            Retry = ConnectRetry
+            NetworkDown.clear()
+            NetworkUp.set()
+            await Notification("Network connected", LevelInfo, "wifi")
+            while wifi.isconnected() and (RadioWanted.is_set() or not LowPower()):
+                await asyncio.sleep(LinkCheck)
+            led.value(0)
+            if wifi.isconnected():
+                # End of a serve window
+                NetworkUp.clear()
+                NetworkDown.set()
+                wifi.disconnect()
+                continue
+            WiFi["drops"] += 1
+            NetworkUp.clear()
+            NetworkDown.set()
+            await Notification("Network lost, reconnecting", LevelWarning, "wifi")
+            wifi.disconnect()
+            continue
+        wifi.disconnect()
+        WiFi["failures"] += 1
+        Count("wifi_connect_error")
+        SetWiFiState("backoff")
+        await asyncio.sleep(Retry)
+        Retry = min(Retry * 2, ConnectRetryMax)
+
+# Web server, listening only while the network is up
+async def WebServer():
     while True:
-        if wifi.isconnected() == False:
-            print("Reconnecting to Wi-Fi")
-            wifi.connect(ssid, password)
-            await Notification("Network reconnected")
-        await asyncio.sleep(600)
-
-try:
-    asyncio.run(main())
-finally:
-    asyncio.new_event_loop()
+        await NetworkUp.wait()
+        Server = await asyncio.start_server(serve_client, "0.0.0.0", 80)
+        print("Web server started")
+        await NetworkDown.wait()
+        Server.close()
+        await Server.wait_closed()
+        print("Web server stopped")
+
+# Only start when run as the program (not when imported, e.g., by the host simulator in "sim")
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    finally:
+        # Don't lose held log records when stopped (e.g., from Thonny)
+        FlushAll()
+        asyncio.new_event_loop()
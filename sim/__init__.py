@@ -0,0 +1,173 @@
+# Host-side simulator for main.py
+## Stand-in "machine", "network", "ntptime", "dht", "deflate", "uasyncio", "time" and "gc" modules let the firmware
+## be imported and driven under CPython: scripted ADC traces, DHT11 failure injection,
+## a simulated clock, flash write accounting and an in-memory (loopback) client for the web server
+##
+## Typical use:
+##     import sim
+##     main = sim.LoadMain()
+##     loop = sim.VirtualLoop()
+##     loop.run_until_complete(main.Juncture())
+
+import builtins
+import gc as _gc
+import importlib.util
+import os
+import sys
+import tempfile
+import tracemalloc
+
+from . import clock, dht, deflate, machine, network, ntptime, uasyncio
+from .clock import CLOCK, TimeModule
+from .uasyncio import VirtualLoop
+
+Root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Counts what the firmware writes to its file system, standing in for wear on the flash
+class FlashMeter:
+    def __init__(self):
+        self.Reset()
+
+    def Reset(self):
+        self.Bytes = 0
+        self.Writes = 0
+        self.Opens = 0
+
+    def Open(self, name, mode="r", *args, **kwargs):
+        f = builtins.open(name, mode, *args, **kwargs)
+        if "w" in mode or "a" in mode or "+" in mode:
+            self.Opens += 1
+            return CountingFile(f, self)
+        return f
+
+class CountingFile:
+    def __init__(self, f, meter):
+        self.File = f
+        self.Meter = meter
+
+    def write(self, data):
+        n = self.File.write(data)
+        self.Meter.Writes += 1
+        # Bytes, not items: len() of an array counts its elements
+        self.Meter.Bytes += len(data.encode()) if isinstance(data, str) else memoryview(data).nbytes
+        return n
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.File.close()
+
+    def __iter__(self):
+        return iter(self.File)
+
+    def __getattr__(self, name):
+        return getattr(self.File, name)
+
+FLASH = FlashMeter()
+
+# Stand-in for MicroPython's "gc" module: heap use is what tracemalloc sees (when tracing) on a Pico W sized heap
+class GCModule:
+    HeapSize = 192 * 1024
+
+    def mem_alloc(self):
+        return tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else 0
+
+    def mem_free(self):
+        return max(0, self.HeapSize - self.mem_alloc())
+
+    def threshold(self, amount=None):
+        return -1
+
+    def __getattr__(self, name):
+        return getattr(_gc, name)
+
+# Put the stand-in modules where "import machine" etc. will find them
+def Install():
+    sys.modules["machine"] = machine
+    sys.modules["network"] = network
+    sys.modules["ntptime"] = ntptime
+    sys.modules["dht"] = dht
+    sys.modules["deflate"] = deflate
+    sys.modules["uasyncio"] = uasyncio
+
+# Import main.py (without starting it) with its working directory as the simulated flash
+## "time" and "gc" are only swapped for the stand-ins while main.py is imported
+def LoadMain(Flash=None):
+    if Flash is None:
+        Flash = tempfile.mkdtemp(prefix="picoflash-")
+    os.makedirs(Flash, exist_ok=True)
+    os.chdir(Flash)
+    Install()
+    Spec = importlib.util.spec_from_file_location("main", os.path.join(Root, "main.py"))
+    Module = importlib.util.module_from_spec(Spec)
+    Module.open = FLASH.Open
+    RealTime = sys.modules["time"]
+    sys.modules["time"] = TimeModule(CLOCK)
+    sys.modules["gc"] = GCModule()
+    try:
+        Spec.loader.exec_module(Module)
+    finally:
+        sys.modules["time"] = RealTime
+        sys.modules["gc"] = _gc
+    sys.modules["main"] = Module
+    return Module
+
+# In-memory client connection for serve_client(): the request is read from bytes, the response collected
+class LoopbackReader:
+    def __init__(self, data):
+        self.Data = data
+
+    async def readline(self):
+        End = self.Data.find(b"\n") + 1 or len(self.Data)
+        line, self.Data = self.Data[:End], self.Data[End:]
+        return line
+
+    async def read(self, n=-1):
+        if n < 0:
+            n = len(self.Data)
+        data, self.Data = self.Data[:n], self.Data[n:]
+        return data
+
+## With Keep=False only the size of the response is kept, for measuring the firmware rather than the client
+class LoopbackWriter:
+    def __init__(self, Keep=True):
+        self.Keep = Keep
+        self.Written = 0
+        self.Chunks = []
+        self.Pending = 0
+        # Most bytes waiting to be sent at once, the socket buffer the device would need
+        self.MaxPending = 0
+        self.Closed = False
+
+    def write(self, data):
+        data = data.encode() if isinstance(data, str) else bytes(data)
+        if self.Keep:
+            self.Chunks.append(data)
+        self.Written += len(data)
+        self.Pending += len(data)
+        self.MaxPending = max(self.MaxPending, self.Pending)
+
+    async def drain(self):
+        self.Pending = 0
+
+    def close(self):
+        self.Closed = True
+
+    async def wait_closed(self):
+        self.Closed = True
+
+    def get_extra_info(self, name, default=None):
+        return ("127.0.0.1", 50000) if name == "peername" else default
+
+    def Response(self):
+        return b"".join(self.Chunks)
+
+# Make one request to the firmware's web server, returning (status line, headers, body, writer)
+async def Request(main, Path, Method="GET", Headers=(), Keep=True):
+    Data = (Method + " " + Path + " HTTP/1.1\r\n" + "".join(h + "\r\n" for h in Headers) + "\r\n").encode()
+    writer = LoopbackWriter(Keep)
+    await main.serve_client(LoopbackReader(Data), writer)
+    Head, _, Body = writer.Response().partition(b"\r\n\r\n")
+    Lines = Head.decode().split("\r\n")
+    return Lines[0], Lines[1:], Body, writer
@@ -0,0 +1,21 @@
+# Run the firmware on this computer: python -m sim [--port 8080] [--flash DIR]
+## Uses the host's clock, the web server is on http://127.0.0.1:<port>/
+
+import argparse
+import asyncio
+
+import sim
+
+Parser = argparse.ArgumentParser(description="Run main.py against the simulated Pico")
+Parser.add_argument("--port", type=int, default=8080)
+Parser.add_argument("--flash", help="directory kept as the Pico's file system (default: a new temporary one)")
+Arguments = Parser.parse_args()
+
+sim.uasyncio.ServerPort = Arguments.port
+sim.CLOCK.UseRealtime()
+main = sim.LoadMain(Arguments.flash)
+print("Serving on http://{}:{}/ with flash in {}".format(sim.uasyncio.ServerHost, Arguments.port, main.os.getcwd()))
+try:
+    asyncio.run(main.main())
+except KeyboardInterrupt:
+    pass
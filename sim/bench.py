@@ -0,0 +1,191 @@
+# Benchmarks of the firmware's hot paths on the simulated Pico: python -m sim.bench
+## Reports per-call latency, peak memory allocated and bytes written to flash for each case
+## --save FILE keeps the results, --compare FILE fails (exit status 1) on a regression against them
+## --power HOURS also runs the whole firmware for that long in each power mode and compares energy estimates
+##
+## Latency is host time and noisy, so only compare results from the same computer;
+## memory is traced in a second pass so tracing doesn't slow the timed pass
+
+import argparse
+import contextlib
+import io
+import json
+import sys
+import time
+import tracemalloc
+
+import sim
+
+# Allowed growth over a saved baseline before a case counts as a regression
+## Latency is measured on the host and varies between runs, memory and flash writes are repeatable
+Tolerances = {"median_us": 0.5, "peak_alloc_bytes": 0.1, "flash_bytes_per_call": 0.1}
+
+def Percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+# Run "Call(n)" Count times timed, then Count times traced for memory
+def Measure(Name, Call, Count):
+    Times = []
+    Flash = sim.FLASH.Bytes
+    for n in range(Count):
+        Start = time.perf_counter()
+        Call(n)
+        Times.append((time.perf_counter() - Start) * 1000000)
+    Written = sim.FLASH.Bytes - Flash
+    Peaks = []
+    tracemalloc.start()
+    for n in range(Count):
+        Base = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        Call(Count + n)
+        Peaks.append(tracemalloc.get_traced_memory()[1] - Base)
+    tracemalloc.stop()
+    return Name, {
+        "calls": Count,
+        "mean_us": round(sum(Times) / Count, 1),
+        "median_us": round(Percentile(Times, 0.5), 1),
+        "p95_us": round(Percentile(Times, 0.95), 1),
+        "max_us": round(max(Times), 1),
+        "peak_alloc_bytes": max(Peaks),
+        "flash_bytes_per_call": round(Written / Count, 1),
+    }
+
+# Fill the RAM buffers as after a long run, without waiting for it
+def Prefill(main, Count):
+    Now = main.time.time()
+    for n in range(Count):
+        sample = (Now - (Count - n) * 60, 40 + n % 20, 55.5, 20 + n % 5, 60)
+        main.StoredInstances.Append(sample)
+        main.MinuteRollup.Update(sample)
+        main.HourRollup.Update(sample)
+        main.SampleLog.Append(main.PackSample(sample))
+
+def Run(Count):
+    main = sim.LoadMain()
+    loop = sim.VirtualLoop()
+    Run = loop.run_until_complete
+    Interval = main.LoggingFrequency()
+    Results = []
+
+    loop.create_task(main.WiFiManager())
+    loop.create_task(main.TimeService())
+    loop.create_task(main.DHTReader())
+    Run(sim.uasyncio.sleep(1))
+    def Juncture(n):
+        sim.CLOCK.Advance(Interval)
+        Run(main.Juncture())
+    Results.append(Measure("Juncture()", Juncture, Count))
+
+    # One logging interval of DataRegister(): a sample read, stored and the log rolled over when full
+    sim.CLOCK.Advance(Interval)
+    loop.create_task(main.DataRegister(main.SampleLog, Interval))
+    Run(sim.uasyncio.sleep(0))
+    def Tick(n):
+        Run(sim.uasyncio.sleep(Interval))
+    Results.append(Measure("DataRegister() tick", Tick, Count))
+
+    # Truncate() with segments small enough that some calls roll the log over
+    Record = main.PackSample((main.time.time(), 40, 50, 20, 60))
+    Size = main.SampleLog.SegmentSize
+    main.SampleLog.SegmentSize = main.SampleSize * 20
+    def Truncate(n):
+        main.SampleLog.Append(Record)
+        Run(main.Truncate(main.SampleLog))
+    Results.append(Measure("Truncate()", Truncate, Count))
+    main.SampleLog.SegmentSize = Size
+
+    Prefill(main, max(main.SampleWindow, 360 * 4))
+    for Span in main.GraphSpans:
+        Results.append(Measure("GraphData(" + Span + ")", lambda n, Span=Span: "".join(main.GraphData(Span)), Count))
+
+    for Path in ("/", "/logs/list", "/logs/monitor", "/static/app.css", "/api/samples?from=-3600", "/api/rollup?tier=hour", "/metrics", "/logs/download"):
+        Headers = ("Accept-Encoding: gzip",)
+        Results.append(Measure("serve_client GET " + Path, lambda n, Path=Path: Run(sim.Request(main, Path, Headers=Headers, Keep=False)), max(1, Count // 4) if Path == "/logs/download" else Count))
+    for task in sim.uasyncio.all_tasks(loop):
+        task.cancel()
+    Run(sim.uasyncio.sleep(0))
+    loop.close()
+    return dict(Results)
+
+# Run the whole firmware for "Hours" of simulated time in each power mode ("PowerMode")
+## The simulator's own account of time in machine.lightsleep() and with the radio powered, at the firmware's
+## "PowerDraw" currents, checks the energy estimate the firmware makes from its own timings
+def Power(Hours):
+    sim.uasyncio.ServerPort = 0
+    Results = {}
+    for Mode in ("normal", "low"):
+        main = sim.LoadMain()
+        main.PowerMode = main.BootPowerMode = Mode
+        loop = sim.VirtualLoop()
+        Start, Slept, Radio = sim.CLOCK.Monotonic, sim.CLOCK.Slept, sim.network.RadioOnSeconds()
+        with contextlib.redirect_stdout(io.StringIO()):
+            loop.create_task(main.main())
+            loop.run_until_complete(sim.uasyncio.sleep(Hours * 3600))
+            Used, Average, Runtime = main.EnergyBudget()
+            for task in sim.uasyncio.all_tasks(loop):
+                task.cancel()
+            loop.run_until_complete(sim.uasyncio.sleep(0))
+        loop.close()
+        Elapsed = sim.CLOCK.Monotonic - Start
+        Asleep = sim.CLOCK.Slept - Slept
+        On = sim.network.RadioOnSeconds() - Radio
+        sim.network.WLAN().active(False)
+        Draw = main.PowerDraw
+        Results[Mode] = {
+            "samples": main.StoredInstances.Appended,
+            "connects": main.WiFi["connects"],
+            "awake_percent": round(100 * (Elapsed - Asleep) / Elapsed, 1),
+            "radio_percent": round(100 * On / Elapsed, 1),
+            "average_ma": round(Average, 2),
+            "sim_average_ma": round(((Elapsed - Asleep) * Draw["awake"] + Asleep * Draw["sleep"] + On * Draw["radio"]) / Elapsed, 2),
+            "runtime_days": round(Runtime / 24, 1),
+        }
+    return Results
+
+def ShowPower(Results, Hours):
+    Row = "{:<8} {:>8} {:>9} {:>8} {:>8} {:>11} {:>11} {:>13}"
+    print("\n{} simulated hours in each power mode".format(Hours))
+    print(Row.format("mode", "samples", "connects", "awake %", "radio %", "average mA", "sim avg mA", "runtime days"))
+    for Mode, R in Results.items():
+        print(Row.format(Mode, R["samples"], R["connects"], R["awake_percent"], R["radio_percent"], R["average_ma"], R["sim_average_ma"], R["runtime_days"]))
+
+def Show(Results):
+    Row = "{:<40} {:>6} {:>10} {:>10} {:>10} {:>10} {:>11} {:>12}"
+    print(Row.format("case", "calls", "mean us", "median us", "p95 us", "max us", "peak alloc", "flash B/call"))
+    for Name, R in Results.items():
+        print(Row.format(Name, R["calls"], R["mean_us"], R["median_us"], R["p95_us"], R["max_us"], R["peak_alloc_bytes"], R["flash_bytes_per_call"]))
+
+# Cases that got slower, allocate more or write more than the baseline allows
+def Regressions(Results, Baseline):
+    Found = []
+    for Name, R in Results.items():
+        B = Baseline.get(Name)
+        if not B:
+            continue
+        for Key in Tolerances:
+            if R[Key] > B[Key] * (1 + Tolerances[Key]) and R[Key] - B[Key] > 1:
+                Found.append("{}: {} {} -> {}".format(Name, Key, B[Key], R[Key]))
+    return Found
+
+if __name__ == "__main__":
+    Parser = argparse.ArgumentParser(description="Benchmark main.py on the simulated Pico")
+    Parser.add_argument("--calls", type=int, default=50, help="calls per case")
+    Parser.add_argument("--save", help="write the results to this JSON file")
+    Parser.add_argument("--compare", help="JSON file of earlier results to check for regressions")
+    Parser.add_argument("--power", type=float, default=24, help="simulated hours to run each power mode for (0 to skip)")
+    Arguments = Parser.parse_args()
+
+    Results = Run(Arguments.calls)
+    Show(Results)
+    if Arguments.power:
+        ShowPower(Power(Arguments.power), Arguments.power)
+    if Arguments.save:
+        with open(Arguments.save, "w") as f:
+            json.dump(Results, f, indent=1)
+    if Arguments.compare:
+        with open(Arguments.compare) as f:
+            Found = Regressions(Results, json.load(f))
+        for line in Found:
+            print("Regression: " + line)
+        sys.exit(1 if Found else 0)
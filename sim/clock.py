@@ -0,0 +1,99 @@
+# Simulated time shared by every stand-in module
+## "Monotonic" seconds since the simulation started drive ticks_ms() and the event loop:
+## time spent computing passes as it would on the device, waiting is skipped unless running in real time,
+## the real-time clock (RTC) is what time.time() reports and only matches true time after an NTP sync
+
+import calendar
+import time as _time
+
+# 13/12/2023 12:00:00 UTC, the default start of a simulation
+DefaultStart = 1702468800
+
+class Clock:
+    def __init__(self, Start=DefaultStart, DriftPPM=0):
+        # True epoch at the start of the simulation
+        self.Start = Start
+        # Really wait when asked to sleep (for running the firmware interactively)
+        self.Realtime = False
+        self.Origin = _time.perf_counter()
+        # Seconds skipped by sleeping
+        self.Virtual = 0.0
+        # RTC and ticks counter (one crystal) run fast (positive) or slow (negative) by this many parts per million
+        self.DriftPPM = DriftPPM
+        # A Pico boots with its RTC at the firmware epoch until it is set
+        self.RTCBase = 0
+        self.RTCSetAt = 0.0
+        # Time spent in machine.lightsleep()
+        self.Slept = 0.0
+
+    @property
+    def Monotonic(self):
+        return self.Virtual + (_time.perf_counter() - self.Origin)
+
+    def Advance(self, Seconds):
+        if Seconds <= 0:
+            return
+        if self.Realtime:
+            _time.sleep(Seconds)
+        else:
+            self.Virtual += Seconds
+
+    def UseRealtime(self):
+        self.Realtime = True
+
+    def TrueEpoch(self):
+        return self.Start + self.Monotonic
+
+    def Epoch(self):
+        return self.RTCBase + (self.Monotonic - self.RTCSetAt) * (1 + self.DriftPPM / 1000000)
+
+    # Called by ntptime.settime()
+    def SetRTC(self, Epoch):
+        self.RTCBase = Epoch
+        self.RTCSetAt = self.Monotonic
+
+CLOCK = Clock()
+
+# Stand-in for MicroPython's "time" module, reading the simulated clock
+class TimeModule:
+    def __init__(self, clock):
+        self.Clock = clock
+
+    def time(self):
+        return int(self.Clock.Epoch())
+
+    def time_ns(self):
+        return int(self.Clock.Epoch() * 1000000000)
+
+    def localtime(self, secs=None):
+        # The Pico has no time zone, local time is UTC
+        return self.gmtime(secs)
+
+    def gmtime(self, secs=None):
+        if secs is None:
+            secs = self.time()
+        return tuple(_time.gmtime(secs))[:8]
+
+    def mktime(self, t):
+        return calendar.timegm(tuple(t[:6]) + (0, 0, 0))
+
+    def sleep(self, seconds):
+        self.Clock.Advance(seconds)
+
+    def sleep_ms(self, ms):
+        self.Clock.Advance(ms / 1000)
+
+    def sleep_us(self, us):
+        self.Clock.Advance(us / 1000000)
+
+    def ticks_ms(self):
+        return int(self.Clock.Monotonic * (1 + self.Clock.DriftPPM / 1000000) * 1000)
+
+    def ticks_us(self):
+        return int(self.Clock.Monotonic * (1 + self.Clock.DriftPPM / 1000000) * 1000000)
+
+    def ticks_diff(self, a, b):
+        return a - b
+
+    def ticks_add(self, a, b):
+        return a + b
@@ -0,0 +1,26 @@
+# Stand-in for MicroPython's "deflate" module (compression only), using zlib
+
+import zlib
+
+AUTO = 0
+RAW = 1
+ZLIB = 2
+GZIP = 3
+
+class DeflateIO:
+    def __init__(self, stream, format=AUTO, wbits=0, close=False):
+        self.Stream = stream
+        Bits = {RAW: -15, ZLIB: 15, GZIP: 31}.get(format, 15)
+        self.Compressor = zlib.compressobj(9, zlib.DEFLATED, Bits)
+        self.Close = close
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        self.Stream.write(self.Compressor.compress(data))
+        return len(data)
+
+    def close(self):
+        self.Stream.write(self.Compressor.flush())
+        if self.Close:
+            self.Stream.close()
@@ -0,0 +1,50 @@
+# Stand-in for MicroPython's "dht" module
+## Like the real DHT11, a measurement less than a second after the last one fails,
+## further failures can be injected at random ("FailureRate") or for a number of reads ("Failures")
+
+import math
+import random
+
+from .clock import CLOCK
+
+FailureRate = 0.0
+Failures = 0
+Random = random.Random(2)
+# Count of measure() calls
+Measures = 0
+
+def DayFraction():
+    return (CLOCK.Epoch() % 86400) / 86400
+
+class DHT11:
+    MinimumInterval = 1.0
+
+    def __init__(self, pin):
+        self.Pin = pin
+        self.Temperature = None
+        self.Humidity = None
+
+    def measure(self):
+        global Failures, Measures
+        Measures += 1
+        Last = getattr(DHT11, "LastMeasure", None)
+        DHT11.LastMeasure = CLOCK.Monotonic
+        if Last is not None and CLOCK.Monotonic - Last < self.MinimumInterval:
+            raise OSError(110)
+        if Failures > 0:
+            Failures -= 1
+            raise OSError(110)
+        if Random.random() < FailureRate:
+            raise OSError(110)
+        Warmth = math.sin((DayFraction() - 0.375) * 2 * math.pi)
+        self.Temperature = int(round(18 + 8 * Warmth))
+        self.Humidity = int(round(60 - 15 * Warmth))
+
+    def temperature(self):
+        return self.Temperature
+
+    def humidity(self):
+        return self.Humidity
+
+class DHT22(DHT11):
+    MinimumInterval = 2.0
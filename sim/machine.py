@@ -0,0 +1,101 @@
+# Stand-in for MicroPython's "machine" module
+## ADC readings come from scripted traces (a function of the simulated clock, or a list played in order)
+
+import math
+import random
+
+from .clock import CLOCK
+
+# Pin number: trace giving the raw 16-bit reading
+Traces = {}
+# Random noise added to every ADC reading (raw counts)
+Noise = 300
+Random = random.Random(1)
+# Count of ADC conversions, to check how often the firmware reads
+Reads = 0
+
+class Pin:
+    IN = 0
+    OUT = 1
+    PULL_UP = 1
+    PULL_DOWN = 2
+
+    def __init__(self, Id, Mode=-1, Pull=-1, value=None):
+        self.Id = Id
+        self.State = 0 if value is None else value
+
+    def value(self, v=None):
+        if v is None:
+            return self.State
+        self.State = 1 if v else 0
+
+    def __call__(self, v=None):
+        return self.value(v)
+
+    def on(self):
+        self.State = 1
+
+    def off(self):
+        self.State = 0
+
+    def init(self, *args, **kwargs):
+        pass
+
+    def __repr__(self):
+        return "Pin({})".format(self.Id)
+
+# Hours of the simulated day as a fraction of a day (0.5 is midday)
+def DayFraction():
+    return (CLOCK.Epoch() % 86400) / 86400
+
+# Default traces: light follows the sun, soil slowly dries out during the day
+def LightTrace():
+    return max(0.0, math.sin((DayFraction() - 0.25) * 2 * math.pi)) * 60000
+
+def SoilTrace():
+    return 20000 + 15000 * DayFraction()
+
+DefaultTraces = {27: SoilTrace, 28: LightTrace}
+
+class ADC:
+    CORE_TEMP = 4
+
+    def __init__(self, Id):
+        self.Id = Id.Id if isinstance(Id, Pin) else Id
+
+    def read_u16(self):
+        global Reads
+        Reads += 1
+        Trace = Traces.get(self.Id, DefaultTraces.get(self.Id, 32768))
+        if isinstance(Trace, list):
+            value = Trace.pop(0) if len(Trace) > 1 else Trace[0]
+        elif callable(Trace):
+            value = Trace()
+        else:
+            value = Trace
+        value = int(value + Random.uniform(-Noise, Noise))
+        return min(max(value, 0), 65535)
+
+def reset():
+    raise SystemExit("machine.reset()")
+
+def soft_reset():
+    reset()
+
+# Sleeping advances the simulated clock at once
+def lightsleep(ms=None):
+    if ms:
+        CLOCK.Advance(ms / 1000)
+        CLOCK.Slept += ms / 1000
+
+def deepsleep(ms=None):
+    lightsleep(ms)
+
+def freq(hz=None):
+    return 125000000
+
+def unique_id():
+    return b"\x00simpico"
+
+def idle():
+    pass
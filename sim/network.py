@@ -0,0 +1,83 @@
+# Stand-in for MicroPython's "network" module, a Wi-Fi station that can be taken down
+## "Available" is whether the access point can be reached, connecting takes "ConnectDelay" seconds
+
+from .clock import CLOCK
+
+STA_IF = 0
+AP_IF = 1
+
+# Connection status codes of the rp2 port
+STAT_IDLE = 0
+STAT_CONNECTING = 1
+STAT_GOT_IP = 3
+STAT_CONNECT_FAIL = -1
+STAT_NO_AP_FOUND = -2
+STAT_WRONG_PASSWORD = -3
+
+Available = True
+ConnectDelay = 2.0
+# Count of connect() calls
+Connects = 0
+# Seconds the radio has been powered (active), for the power model in "sim.bench"
+RadioSeconds = 0.0
+
+def RadioOnSeconds():
+    return RadioSeconds + (CLOCK.Monotonic - WLAN.ActiveSince if WLAN.Active else 0)
+
+class WLAN:
+    # One interface object, as on the device
+    Active = False
+    ActiveSince = 0.0
+    Connecting = None
+    Connected = False
+
+    def __init__(self, Interface=STA_IF):
+        self.Interface = Interface
+
+    def active(self, state=None):
+        global RadioSeconds
+        if state is None:
+            return WLAN.Active
+        if state and not WLAN.Active:
+            WLAN.ActiveSince = CLOCK.Monotonic
+        elif WLAN.Active and not state:
+            RadioSeconds += CLOCK.Monotonic - WLAN.ActiveSince
+        WLAN.Active = bool(state)
+        if not state:
+            WLAN.Connected = False
+            WLAN.Connecting = None
+
+    def config(self, *args, **kwargs):
+        if args:
+            return 0
+
+    def connect(self, ssid=None, password=None):
+        global Connects
+        Connects += 1
+        WLAN.Connecting = CLOCK.Monotonic
+
+    def disconnect(self):
+        WLAN.Connected = False
+        WLAN.Connecting = None
+
+    def status(self, *args):
+        if not WLAN.Active:
+            return STAT_IDLE
+        if WLAN.Connected and Available:
+            return STAT_GOT_IP
+        WLAN.Connected = False
+        if WLAN.Connecting is None:
+            return STAT_IDLE
+        if not Available:
+            return STAT_NO_AP_FOUND
+        if CLOCK.Monotonic - WLAN.Connecting >= ConnectDelay:
+            WLAN.Connected = True
+            WLAN.Connecting = None
+            return STAT_GOT_IP
+        return STAT_CONNECTING
+
+    def isconnected(self):
+        return self.status() == STAT_GOT_IP
+
+    def ifconfig(self, *args):
+        return ("127.0.0.1", "255.0.0.0", "127.0.0.1", "127.0.0.1")
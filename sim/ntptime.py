@@ -0,0 +1,24 @@
+# Stand-in for MicroPython's "ntptime" module, setting the simulated RTC to true time
+
+from .clock import CLOCK
+from . import network
+
+host = "pool.ntp.org"
+timeout = 1
+# Number of upcoming requests that fail (as if the packet was lost)
+Failures = 0
+# Count of requests made
+Requests = 0
+
+def time():
+    global Failures, Requests
+    Requests += 1
+    if Failures > 0:
+        Failures -= 1
+        raise OSError(110)
+    if not network.WLAN.Connected or not network.Available:
+        raise OSError(-2)
+    return int(CLOCK.TrueEpoch())
+
+def settime():
+    CLOCK.SetRTC(time())
@@ -0,0 +1,64 @@
+# Stand-in for MicroPython's "uasyncio" module, CPython's asyncio with the MicroPython extras
+## VirtualLoop() runs the event loop on the simulated clock: when every task is waiting,
+## the clock jumps to the next timer instead of sleeping, so hours of firmware time run in moments
+
+import asyncio as _asyncio
+import selectors
+from asyncio import *
+
+from .clock import CLOCK
+
+async def sleep_ms(ms):
+    await _asyncio.sleep(ms / 1000)
+
+def wait_for_ms(aw, ms):
+    return _asyncio.wait_for(aw, ms / 1000)
+
+# MicroPython's flag set from interrupts, here just an event that clears itself when waited on
+class ThreadSafeFlag:
+    def __init__(self):
+        self.Event = _asyncio.Event()
+
+    def set(self):
+        self.Event.set()
+
+    def clear(self):
+        self.Event.clear()
+
+    async def wait(self):
+        await self.Event.wait()
+        self.Event.clear()
+
+class VirtualSelector(selectors.DefaultSelector):
+    def select(self, timeout=None):
+        Events = super().select(0)
+        if not Events and timeout:
+            CLOCK.Advance(timeout)
+        return Events
+
+class VirtualLoop(_asyncio.SelectorEventLoop):
+    def __init__(self):
+        super().__init__(VirtualSelector())
+
+    def time(self):
+        return CLOCK.Monotonic
+
+# The firmware's web server is served on this host address instead of port 80 on all interfaces
+ServerHost = "127.0.0.1"
+ServerPort = 8080
+
+# Socket writers on the device take str as well as bytes
+class TextWriter:
+    def __init__(self, writer):
+        self.Writer = writer
+
+    def write(self, data):
+        self.Writer.write(data.encode() if isinstance(data, str) else bytes(data))
+
+    def __getattr__(self, name):
+        return getattr(self.Writer, name)
+
+async def start_server(callback, host, port, backlog=5):
+    async def Client(reader, writer):
+        await callback(reader, TextWriter(writer))
+    return await _asyncio.start_server(Client, ServerHost, ServerPort, backlog=backlog)